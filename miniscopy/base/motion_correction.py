@@ -50,9 +50,17 @@ from tqdm import tqdm
 import os
 import sys
 import h5py as hd
+from collections import OrderedDict
+import hashlib
+import json
+import time
+import threading
+import queue
 from IPython.core.debugger import Pdb
 from copy import copy
 from miniscopy.base.sima_functions import *
+from miniscopy.base.utilities import FloatDataset, cast_frames, create_dataset, set_storage_options, get_frame_chunks, write_tiled_copy, MemmapFile, open_file, read_frames
+from multiprocessing import shared_memory, resource_tracker
 
 
 def get_vector_field_image (folder_name,shift_appli, parameters):
@@ -117,34 +125,21 @@ def vector_field (matrix_X, matrix_Y,strides,wdims,pdims,dims):
     -strides = np.array, (top,left) coordinates of each patch
     -wdims = np.array, dimension of each patch (h,w)
     -dims = dimension of the image
-    -pdims = np.array, (number of patches on heigt, number of patches on weight)"""
-    x= np.zeros(pdims[1])
-    y= np.zeros(pdims[0])
-    for i in range(0,pdims[1]):
-        x[i]= np.minimum(strides[1]*i + wdims[1]/2, dims[1])
-    for j in range(0,pdims[0]):
-        y[j]= np.minimum(strides[0]*j + wdims[0]/2, dims[0])
+    -pdims = np.array, (number of patches on heigt, number of patches on weight)
+
+    Returns:
+    -X, Y : the coordinates of the center of each patch
+    -U, V : the shifts, nan where there is no shift
+    -Xp, Yp : the coordinates of the patches without shift, nan elsewhere"""
+    x = np.minimum(strides[1]*np.arange(pdims[1]) + wdims[1]/2, dims[1])
+    y = np.minimum(strides[0]*np.arange(pdims[0]) + wdims[0]/2, dims[0])
     X,Y = np.meshgrid(x,y)
 
-    X_flat = np.ravel(X.copy())
-    Y_flat = np.ravel(Y.copy())
-    U_flat= np.ravel(matrix_Y.copy())
-    V_flat = np.ravel(matrix_X.copy())
-    xp = np.zeros(U_flat.shape)
-    yp = np.zeros(V_flat.shape) 
-    xp.fill(np.nan)
-    yp.fill(np.nan)
-    for i, uf in enumerate(U_flat): 
-        if uf == 0 and V_flat[i] == 0 : # if there is no shift
-            U_flat[i] = None
-            V_flat[i] = None
-            xp[i] = X_flat[i]
-            yp[i] = Y_flat[i]
-
-    U = U_flat.reshape(pdims)
-    V = V_flat.reshape(pdims)
-    Xp = xp.reshape(pdims)
-    Yp = yp.reshape(pdims)
+    no_shift = (np.reshape(matrix_Y, pdims) == 0) & (np.reshape(matrix_X, pdims) == 0)
+    U = np.where(no_shift, np.nan, np.reshape(matrix_Y, pdims))
+    V = np.where(no_shift, np.nan, np.reshape(matrix_X, pdims))
+    Xp = np.where(no_shift, X, np.nan)
+    Yp = np.where(no_shift, Y, np.nan)
 
     return (X,Y,U,V,Xp,Yp)
 
@@ -290,34 +285,243 @@ def get_video_info(files):
 
 
 
-def get_hdf_file(videos, video_info, dims, save_original, **kwargs):
+def get_video_batches(video, dims, duration, batch_size, dtype = np.float32):
+    """ Decode a video in batches of frames so that only one batch is held in memory at a time.
+
+    Parameters:
+    -video : av container of the video
+    -dims : dimension (h,w) of each frame
+    -duration : number of frames to decode
+    -batch_size : number of frames in each batch
+    -dtype : type of the returned frames
+
+    Yields:
+    -start : index of the first frame of the batch in the video
+    -batch : ndarray (n, h*w). The same buffer is reused for the next batch."""
+
+    stream  = next(s for s in video.streams if s.type == 'video')
+    batch   = np.zeros((min(batch_size, duration), np.prod(dims)), dtype=dtype)
+    start   = 0
+    count   = 0
+    for packet in video.demux(stream):
+        for frame in packet.decode():
+            batch[count]    = frame.to_ndarray(format = 'bgr24')[:,:,0].reshape(np.prod(dims))
+            count           += 1
+            if count == len(batch) or start+count == duration:
+                yield start, batch[:count]
+                start       += count
+                count       = 0
+            if start == duration : return
+    # the file has less frames than expected (truncated recording)
+    if count > 0:
+        yield start, batch[:count]
+
+
+class VideoStore(object):
+    """
+        Random access to the frames of the avi files of a session by global frame number, without converting them to HDF5.
+        A frame number is mapped to its file and to its index in the file with the start of each video (see get_video_info).
+        The videos are decoded by blocks of block_size frames after a seek of PyAV to the closest key frame and
+        the last cache_size decoded blocks are kept in memory (least recently used cache).
+        The store is sliced like the movie dataset of the hdf5 file : store[start:end] returns an array (n, h*w) of uint8.
+    """
+
+    def __init__(self, files, block_size = 100, cache_size = 8):
+        self.video_info, self.videos, self.dims = get_video_info(files)
+        self.video_info = self.video_info.sort_index()
+        self.files      = list(self.video_info.index.get_level_values(1))
+        self.starts     = self.video_info['start'].values.astype(np.int64)
+        self.durations  = self.video_info['duration'].values.astype(np.int64)
+        self.duration   = int(self.durations.sum())
+        self.block_size = int(block_size)
+        self.cache_size = int(cache_size)
+        self.cache      = OrderedDict()
+
+    def __len__(self):
+        return self.duration
+
+    @property
+    def shape(self):
+        return (self.duration, int(np.prod(self.dims)))
+
+    @property
+    def dtype(self):
+        return np.dtype(np.uint8)
+
+    def locate(self, frame):
+        """ Return the index of the video that contains the global frame number and the index of the frame in this video """
+        if frame < 0 or frame >= self.duration:
+            raise IndexError("Frame " + str(frame) + " out of range for a movie of " + str(self.duration) + " frames")
+        num = int(np.searchsorted(self.starts, frame, side = 'right')) - 1
+        return num, int(frame - self.starts[num])
+
+    def decode_block(self, num, block):
+        """ Decode the frames block*block_size to (block+1)*block_size of the video num """
+        video   = self.videos[self.files[num]]
+        stream  = next(s for s in video.streams if s.type == 'video')
+        start   = block*self.block_size
+        count   = int(min(self.block_size, self.durations[num] - start))
+        frames  = np.zeros((count, int(np.prod(self.dims))), dtype = np.uint8)
+        rate    = float(stream.average_rate * stream.time_base) # number of frames in a unit of pts
+        video.seek(int(start / rate), stream = stream, backward = True, any_frame = False)
+        index   = None
+        for packet in video.demux(stream):
+            for frame in packet.decode():
+                if index is None:
+                    if frame.pts is None or int(round(frame.pts * rate)) > start: # the seek is not reliable, decode from the first frame
+                        return self.decode_sequential(num, block)
+                    index = int(round(frame.pts * rate))
+                if index >= start:
+                    frames[index-start] = frame.to_ndarray(format = 'bgr24')[:,:,0].reshape(-1)
+                index += 1
+                if index == start+count:
+                    return frames
+        return frames
+
+    def decode_sequential(self, num, block):
+        """ Decode the video num from the first frame up to the block """
+        video   = self.videos[self.files[num]]
+        stream  = next(s for s in video.streams if s.type == 'video')
+        video.seek(0, stream = stream)
+        end     = int(min((block+1)*self.block_size, self.durations[num]))
+        for start, batch in get_video_batches(video, self.dims, end, self.block_size, dtype = np.uint8):
+            if start == block*self.block_size:
+                return batch.copy()
+
+    def get_block(self, num, block):
+        key = (num, block)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+        else:
+            self.cache[key] = self.decode_block(num, block)
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last = False)
+        return self.cache[key]
+
+    def get_frames(self, start, end):
+        """ Return the frames start to end as an array (end-start, h*w) of uint8 """
+        frames  = np.zeros((max(end-start, 0), int(np.prod(self.dims))), dtype = np.uint8)
+        frame   = start
+        while frame < end:
+            num, index  = self.locate(frame)
+            block       = index // self.block_size
+            data        = self.get_block(num, block)
+            first       = index - block*self.block_size
+            count       = min(len(data) - first, end - frame)
+            frames[frame-start:frame-start+count] = data[first:first+count]
+            frame       += count
+        return frames
+
+    def __getitem__(self, key):
+        rows, columns = (key[0], key[1:]) if isinstance(key, tuple) else (key, ())
+        if isinstance(rows, (int, np.integer)):
+            rows = int(rows) + self.duration if rows < 0 else int(rows)
+            return self.get_frames(rows, rows+1)[(0,)+columns]
+        if isinstance(rows, slice):
+            start, end, step = rows.indices(self.duration)
+            if step == 1:
+                frames = self.get_frames(start, end)
+            else:
+                frames = np.array([self.get_frames(i, i+1)[0] for i in range(start, end, step)], dtype = np.uint8).reshape(-1, self.shape[1])
+        else:
+            frames = np.array([self.get_frames(i, i+1)[0] for i in np.asarray(rows).reshape(-1)], dtype = np.uint8).reshape(-1, self.shape[1])
+        return frames[(slice(None),)+columns]
+
+    def close(self):
+        for video in self.videos.values():
+            video.close()
+        self.cache = OrderedDict()
+
+
+def decode_video(file_name, dims, duration):
+    """ Decode a whole video file. Used by the workers of the cluster during the conversion to HDF5.
+    Frames are kept in 8 bits to limit the size of the data sent back to the main process.
+
+    Parameters:
+    -file_name : str, path of the avi file
+    -dims : dimension (h,w) of each frame
+    -duration : number of frames of the video
+
+    Returns:
+    -file_name : str
+    -frames : ndarray (duration, h*w) of uint8"""
+
+    video   = av.open(file_name)
+    frames  = np.zeros((0, np.prod(dims)), dtype = np.uint8)
+    for start, batch in get_video_batches(video, dims, duration, duration, dtype = np.uint8):
+        frames = batch
+    video.close()
+    return file_name, frames
+
+def decode_video_helper(args): return decode_video(*args)
+
+
+def get_hdf_file(videos, video_info, dims, save_original, batch_size = 100, procs = None, movie_dtype = 'float32', original_dtype = 'float32', storage = None, chunk_frames = None, backend = 'hdf5', copy_on_write = False, **kwargs):
     """
     In order to convert the video into a HDF5 file.
+    The videos are decoded and written by batches of frames so the memory used does not depend on the duration of the recording.
+    If a multiprocessing pool is given, each video file is decoded by a different worker and written at its offset in the file,
+    with at most one decoded file per worker waiting to be written.
     Parameters : 
     -videos : dictionnary of the videos from the miniscopes
     -video_info : DataFrame of informations about the video
     -dims : dimension (h,w) of each frame
+    -batch_size : number of frames written to the file at once
+    -procs : pool of processes or None
+    -movie_dtype : type of the movie dataset ('float32' or 'uint8' to keep the 8 bits of the camera)
+    -original_dtype : type of the original dataset
+    -storage : dict of the compression filter of every dataset of the file (see set_storage_options)
+    -chunk_frames : number of frames in each chunk of the datasets (see get_frame_chunks)
+    -backend : 'hdf5' or 'memmap' to store the movies in binary files opened with np.memmap (see MemmapFile)
+    -copy_on_write : bool, with save_original the frames are only written in original and the movie is read from original until it is corrected (see get_source)
     
     Returns :
-    -file : HDF5 file"""
+    -file : HDF5 file or MemmapFile"""
     hdf_mov     = os.path.split(video_info.index.get_level_values(1)[0])[0] + '/' + 'motion_corrected.hdf5'
-    file        = hd.File(hdf_mov, "w")
-    movie       = file.create_dataset('movie', shape = (video_info['duration'].sum(), np.prod(dims)), dtype = np.float32, chunks=True)
+    file        = MemmapFile(hdf_mov, "w") if backend == 'memmap' else hd.File(hdf_mov, "w")
+    if storage is not None:
+        set_storage_options(file, **storage)
+    duration    = video_info['duration'].sum()
+    movie       = create_dataset(file, 'movie', shape = (duration, np.prod(dims)), dtype = movie_dtype, chunks = get_frame_chunks(dims, duration, movie_dtype, chunk_frames))
     if save_original:
-        original = file.create_dataset('original', shape = (video_info['duration'].sum(), np.prod(dims)), dtype = np.float32, chunks=True)
-    for v in tqdm(videos.keys()):
-        offset  = int(video_info['start'].xs(v, level=1))
-        stream  = next(s for s in videos[v].streams if s.type == 'video')        
-        tmp     = np.zeros((video_info['duration'].xs(v, level=1).values[0], np.prod(dims)), dtype=np.float32)
-        for i, packet in enumerate(videos[v].demux(stream)):
-            frame           = packet.decode()[0].to_ndarray(format = 'bgr24')[:,:,0].astype(np.float32)
-            tmp[i]          = frame.reshape(np.prod(dims))
-            if i+1 == stream.duration : break                        
-            
-        movie[offset:offset+len(tmp),:] = tmp[:]
+        original = create_dataset(file, 'original', shape = (duration, np.prod(dims)), dtype = original_dtype, chunks = get_frame_chunks(dims, duration, original_dtype, chunk_frames))
+        original.attrs['dims'] = dims
+        original.attrs['duration'] = duration
+
+    copy_on_write = copy_on_write and save_original
+    if copy_on_write:
+        movie.attrs['source'] = 'original'
+
+    def write_batch(offset, batch):
+        if not copy_on_write:
+            movie[offset:offset+len(batch),:] = batch
         if save_original:
-            original[offset:offset+len(tmp),:] = tmp[:]
-        del tmp
+            original[offset:offset+len(batch),:] = batch
+
+    if procs is not None and 'multiprocessing' in str(type(procs)):
+        args = [(v, dims, int(video_info['duration'].xs(v, level=1).values[0])) for v in videos.keys()]
+        # a new file is sent each time a decoded one is received so that no more than one file per worker is decoded or waiting to be written
+        done    = queue.Queue()
+        pending = iter(args)
+        for a in itertools.islice(pending, get_pool_size(procs)):
+            procs.apply_async(decode_video_helper, (a,), callback = done.put, error_callback = done.put)
+        for i in tqdm(range(len(args))):
+            result  = done.get()
+            if isinstance(result, BaseException):
+                raise result
+            v, frames = result
+            for a in itertools.islice(pending, 1):
+                procs.apply_async(decode_video_helper, (a,), callback = done.put, error_callback = done.put)
+            offset  = int(video_info['start'].xs(v, level=1))
+            for start in range(0, len(frames), batch_size):
+                write_batch(offset+start, frames[start:start+batch_size])
+            del frames
+    else:
+        for v in tqdm(videos.keys()):
+            offset  = int(video_info['start'].xs(v, level=1))
+            duration = int(video_info['duration'].xs(v, level=1).values[0])
+            for start, batch in get_video_batches(videos[v], dims, duration, batch_size, dtype = np.uint8):
+                write_batch(offset+start, batch)
     if save_original:
         del original
     del movie 
@@ -327,14 +531,122 @@ def get_hdf_file(videos, video_info, dims, save_original, **kwargs):
     return file
 
 
+# parameters of normcorre that change the content of the hdf5 file after the conversion of the videos
+INGEST_PARAMETERS = ['save_original', 'original_dtype', 'movie_dtype', 'storage', 'chunk_frames', 'backend']
+# parameters of normcorre that do not change the corrected movie
+RUN_PARAMETERS = ['resume', 'cache', 'ingest_batch_size', 'tiled_copy', 'tile_frames', 'shared_memory', 'pipeline', 'frames_per_task', 'task_time']
+
+
+def get_ingest_key(files, parameters):
+    """ Key of the content of the hdf5 file after the conversion of the videos.
+    It depends on the name, the size and the modification time of each video and on the parameters of the conversion.
+
+    Parameters:
+    -files : list of the avi files
+    -parameters : dict of the motion correction
+
+    Returns:
+    -key : str"""
+
+    content = [[os.path.basename(f), os.stat(f).st_size, os.stat(f).st_mtime_ns] for f in sorted(files)]
+    content.append({k:parameters.get(k) for k in INGEST_PARAMETERS})
+    return hashlib.sha1(json.dumps(content, sort_keys = True, default = str).encode()).hexdigest()
+
+
+def get_correction_key(parameters):
+    """ Key of the parameters of the motion correction, saved in the movie once the correction is finished """
+    content = {k:v for k, v in parameters.items() if k not in RUN_PARAMETERS}
+    return hashlib.sha1(json.dumps(content, sort_keys = True, default = str).encode()).hexdigest()
+
+
+def update_tiled_copy(hdf_mov, parameters):
+    """ Write the copy of the movie contiguous in time for the patches of CNMFE (see write_tiled_copy) with the parameter tiled_copy
+    if it is missing or has other chunks. The copy is not part of the key of the motion correction. Not needed when the movie is a memmap """
+    if not parameters.get('tiled_copy', False) or isinstance(hdf_mov, MemmapFile):
+        return
+    tile_frames = int(np.clip(parameters.get('tile_frames', 128), 1, max(hdf_mov['movie'].shape[0], 1)))
+    if 'movie_tiled' not in hdf_mov.keys() or hdf_mov['movie_tiled'].chunks[0] != tile_frames:
+        write_tiled_copy(hdf_mov, 'movie', tile_frames)
+
+
+def copy_frames(source, target):
+    """ Copy a movie dataset in another one chunk by chunk so that the memory used does not depend on the duration """
+    size        = source.chunks[0] if source.chunks is not None else target.chunks[0]
+    for i in range(0, len(source), size):
+        target[i:i+size] = cast_frames(source[i:i+size], target.dtype)
+
+
+def get_source(hdf_mov):
+    """ Return the dataset the motion correction reads the frames from.
+    In copy on write mode, the movie is empty until the first round of the motion correction writes the corrected frames
+    and the frames are read from the dataset original (see the attribute source of the movie)."""
+    return hdf_mov[hdf_mov['movie'].attrs.get('source', 'movie')]
+
+
+def copy_original(hdf_mov, parameters):
+    """ Create the dataset movie from the dataset original before a new motion correction.
+    The previous corrected movie and its tiled copy are removed. The copy is done chunk by chunk.
+    With the parameter copy_on_write, nothing is copied : the movie is only allocated when the corrected frames are written
+    and it is read from original until then (see get_source).
+
+    Parameters:
+    -hdf_mov : the hdf5 file with the dataset original and its attributes dims and duration
+    -parameters : dict of the motion correction
+
+    Returns:
+    -dims : dimension (h,w) of each frame
+    -duration : number of frames of the movie"""
+
+    original    = hdf_mov['original']
+    duration    = int(original.attrs['duration'])
+    dims        = tuple(original.attrs['dims'])
+    for name in ['movie', 'movie_tiled', 'template']:
+        if name in hdf_mov.keys():
+            del hdf_mov[name]
+    movie_dtype = parameters.get('movie_dtype', 'float32')
+    movie       = create_dataset(hdf_mov, 'movie', shape = (duration, dims[0]*dims[1]), dtype = movie_dtype, chunks = get_frame_chunks(dims, duration, movie_dtype, parameters.get('chunk_frames')))
+    if parameters.get('copy_on_write', False):
+        movie.attrs['source'] = 'original'
+    else:
+        copy_frames(original, movie)
+    return dims, duration
+
+
 def get_template(movie, dims, start = 0, duration = 1):
-    if np.isnan(movie[start:start+duration]).sum(): 
-        template     = np.nanmedian(movie[start:start+duration], axis = 0).reshape(dims)
+    frames = np.asarray(movie[start:start+duration], dtype = np.float32)
+    if np.isnan(frames).sum(): 
+        template     = np.nanmedian(frames, axis = 0).reshape(dims)
     else :
-        template     = np.median(movie[start:start+duration], axis = 0).reshape(dims)
+        template     = np.median(frames, axis = 0).reshape(dims)
     return template
 
 
+def update_template(template, frames, dims, rate = 0.5):
+    """ Running approximate median of the corrected frames, updated in memory after each chunk instead of get_template.
+    Each pixel of the template moves by rate * mean(|frames - template|) * mean(sign(frames - template)) : it does not move
+    at the median of the frames and it moves by a fraction of the distance to the frames when they are all on the same side.
+    Nothing is sorted and the frames are not read back from the file.
+
+    Parameters:
+    -template : ndarray (h,w), the current template
+    -frames : ndarray (n, h*w), the corrected frames of a chunk
+    -dims : dimension (h,w) of each frame
+    -rate : float between 0 and 1
+
+    Returns:
+    -template : ndarray (h,w)"""
+
+    template    = np.asarray(template, dtype = np.float32).reshape(dims)
+    frames      = np.asarray(frames, dtype = np.float32).reshape((-1,)+tuple(dims))
+    if len(frames) == 0:
+        return template
+    diff        = frames - template
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning) # pixels that are nan in every frame
+        step    = rate * np.nanmean(np.abs(diff), axis = 0) * np.nanmean(np.sign(diff), axis = 0)
+    return template + np.where(np.isfinite(step), step, 0).astype(np.float32)
+
+
 def get_patches_position(dims, strides, overlaps, **kwargs):
     ''' Return a matrix of the position of each patches without overlapping, the dimension of each patch and the dimension of this matrix 
 
@@ -352,6 +664,135 @@ def get_patches_position(dims, strides, overlaps, **kwargs):
     return patches_index.reshape(patches_index.shape[0], np.prod(patches_index.shape[1:])).transpose(), wdims, pdims
 
 
+class PatchGeometry(object):
+    """
+        Position of the patches of tile_and_correct and weights of the blending of the upsampled patches.
+        They only depend on dims, strides, overlaps and upsample_factor_grid and are computed once (see get_patch_geometry).
+        For the blending, the pixels of every upsampled patch inside the image are flattened with their weight so that
+        the corrected patches are added to the image with one np.bincount (see blend).
+    """
+
+    def __init__(self, dims, parameters):
+        self.dims = tuple(dims)
+        self.patches_index, self.wdims, self.pdims = get_patches_position(self.dims, **parameters)
+        self.new_overlaps = parameters['overlaps']
+        self.new_strides = tuple(np.round(np.divide(parameters['strides'], parameters['upsample_factor_grid'])).astype(np.int))
+        self.upsamp_patches_index, self.upsamp_wdims, self.upsamp_pdims = get_patches_position(self.dims, self.new_strides, self.new_overlaps)
+        self.get_blending_weights()
+        self.grid_x, self.grid_y = np.meshgrid(np.arange(self.dims[1], dtype = np.float32), np.arange(self.dims[0], dtype = np.float32)) # coordinates of the pixels for cv2.remap
+        self.get_field_coordinates()
+
+    def get_field_coordinates(self):
+        """ Position of each pixel in the grid of the upsampled patches, for the interpolation of their shifts at every pixel (see apply_shift_field).
+        The shift of a patch is the shift of its center, the part of the patch inside the image. The shifts are constant
+        between the centers of the patches of the border and the border of the image """
+        coordinates = []
+        for axis in range(2):
+            starts  = np.unique(self.upsamp_patches_index[:, axis])
+            centers = (starts + np.minimum(starts + self.upsamp_wdims[axis], self.dims[axis]) - 1) / 2.
+            coordinates.append(np.interp(np.arange(self.dims[axis]), centers, np.arange(len(centers))).astype(np.float32))
+        self.field_x, self.field_y = np.meshgrid(coordinates[1], coordinates[0]) # column and row in the grid of the patches
+
+    def get_blending_weights(self):
+        """ Weight of each pixel of each upsampled patch. The weight is different for the patches at the corners and at the borders """
+        upsamp_wdims, new_overlaps = self.upsamp_wdims, self.new_overlaps
+        tmp             = np.ones(upsamp_wdims)    
+        tmp[:new_overlaps[0], :] = np.linspace(0, 1, new_overlaps[0])[:, None]
+        corner          = np.flip(tmp, 0) * np.rot90(tmp, -1)
+        tmp             = tmp*np.flip(tmp, 0)
+        tmp2            = np.ones(upsamp_wdims)    
+        tmp2[:, :new_overlaps[1]] = np.linspace(0, 1, new_overlaps[1])[None, :]
+        tmp2            = tmp2*np.flip(tmp2, 1)
+        blending_func   = tmp*tmp2        
+        upper_band      = np.ones(upsamp_wdims)    
+        upper_band[-new_overlaps[0]:,:] = np.linspace(1, 0, new_overlaps[0])[:, None]
+        upper_band      = np.rot90(upper_band, -1)*upper_band*np.rot90(upper_band, 1)
+        left_band       = np.rot90(upper_band, 1)
+
+        pixel_index, patch_index, weights = [], [], []
+        for i, patch_pos in enumerate(self.upsamp_patches_index):
+            xs, xe, ys, ye = (patch_pos[0],patch_pos[0]+upsamp_wdims[0],patch_pos[1],patch_pos[1]+upsamp_wdims[1])        
+            ye = np.minimum(ye, self.dims[1])
+            xe = np.minimum(xe, self.dims[0])
+            if xs != 0 and ys != 0 and xe != self.dims[0] and ye != self.dims[1]:
+                weight = blending_func
+            elif xs == 0 and ys == 0: # upper left corner
+                weight = corner
+            elif xs == 0 and ye == self.dims[1]: # upper right corner
+                weight = np.rot90(corner, -1)
+            elif xe == self.dims[0] and ys == 0: # lower left corner
+                weight = np.rot90(corner, 1)
+            elif xe == self.dims[0] and ye == self.dims[1]: # lower right corner
+                weight = np.rot90(corner, 2)
+            elif xs == 0: # upper
+                weight = upper_band
+            elif xe == self.dims[0]: # lower
+                weight = np.flip(upper_band, 0)
+            elif ys == 0: # left
+                weight = left_band
+            else: # right
+                weight = np.flip(left_band, 1)
+            x, y = np.meshgrid(np.arange(xs, xe), np.arange(ys, ye), indexing = 'ij')
+            pixel_index.append(np.ravel_multi_index((x.ravel(), y.ravel()), self.dims))
+            patch_index.append(np.ravel_multi_index((np.full(x.size, i), x.ravel()-xs, y.ravel()-ys), (len(self.upsamp_patches_index),)+tuple(upsamp_wdims)))
+            weights.append(weight[0:xe-xs,0:ye-ys].ravel())
+
+        self.pixel_index    = np.concatenate(pixel_index)
+        self.patch_index    = np.concatenate(patch_index)
+        self.weights        = np.concatenate(weights)
+        self.normalizer     = 1 + np.bincount(self.pixel_index, self.weights, minlength = np.prod(self.dims)) # when no pixel of the patches is nan
+
+    def blend(self, image, new_upsamp_patches):
+        """ Weighted average of the image and of the corrected upsampled patches. The nan pixels of the patches are ignored.
+
+        Parameters:
+        -image : ndarray (h,w)
+        -new_upsamp_patches : ndarray (number of upsampled patches, upsampled patch height, upsampled patch width)
+
+        Returns:
+        -new_image : ndarray (h,w)"""
+
+        values          = new_upsamp_patches.reshape(-1)[self.patch_index]
+        weighted        = values*self.weights
+        weighted[np.isnan(weighted)] = 0
+        new_image       = image.reshape(-1) + np.bincount(self.pixel_index, weighted, minlength = len(self.normalizer))
+        normalizer      = self.normalizer
+        nan_values      = np.isnan(values)
+        if nan_values.any():
+            normalizer  = normalizer - np.bincount(self.pixel_index[nan_values], self.weights[nan_values], minlength = len(self.normalizer))
+        return (new_image/normalizer).astype(image.dtype).reshape(self.dims)
+
+
+_patch_geometries = {}
+
+def get_patch_geometry(dims, parameters):
+    """ Return the PatchGeometry of the parameters. It is computed once for each process """
+    key = (tuple(dims), tuple(parameters['strides']), tuple(parameters['overlaps']), parameters['upsample_factor_grid'])
+    if key not in _patch_geometries:
+        _patch_geometries[key] = PatchGeometry(dims, parameters)
+    return _patch_geometries[key]
+
+
+def apply_shift_field(img, shift_img_x, shift_img_y, geometry):
+    """Warp the whole image with the shifts of the patches interpolated at every pixel (apply_mode 'remap' of tile_and_correct).
+    A pixel moves as with apply_shift_iteration but the shift changes smoothly across the image so there is no seam between patches.
+
+    Parameters:
+    -img : ndarray (h,w), image to be transformed
+    -shift_img_x, shift_img_y : ndarray, the shifts of the upsampled patches
+    -geometry : PatchGeometry of the image
+
+    Returns:
+    - img : ndarray, image transformed"""
+
+    # bilinear interpolation between the centers of the patches (see PatchGeometry.get_field_coordinates)
+    shift_x     = cv2.remap(np.float32(shift_img_x), geometry.field_x, geometry.field_y, interpolation = cv2.INTER_LINEAR, borderMode = cv2.BORDER_REPLICATE)
+    shift_y     = cv2.remap(np.float32(shift_img_y), geometry.field_x, geometry.field_y, interpolation = cv2.INTER_LINEAR, borderMode = cv2.BORDER_REPLICATE)
+    min_, max_  = np.min(img), np.max(img)
+    img         = cv2.remap(np.float32(img), geometry.grid_x - shift_y, geometry.grid_y - shift_x, interpolation = cv2.INTER_CUBIC, borderMode = cv2.BORDER_REFLECT)
+    return np.clip(img, min_, max_)
+
+
 def apply_shift_iteration(img, shift, border_nan=False, border_type=cv2.BORDER_REFLECT):
     """Applied an affine transformation to an image
     
@@ -386,27 +827,95 @@ def apply_shift_iteration(img, shift, border_nan=False, border_type=cv2.BORDER_R
     return img
 
 
-def tile_and_correct(image, template, dims, parameters):
+def get_patch_groups(dims, parameters):
+    """ Return the patches registered by tile_and_correct grouped by shape (the patches at the border of the image are smaller).
+
+    Returns:
+    -groups : dict, for each shape the list of (index of the patch, xs, xe, ys, ye)"""
+
+    patches_index, wdims, pdims    = get_patches_position(dims, **parameters)
+    groups          = {}
+    for i,patch_pos in enumerate(patches_index):
+        xs, xe, ys, ye = (patch_pos[0],np.minimum(patch_pos[0]+wdims[0],dims[0]-1),patch_pos[1],np.minimum(patch_pos[1]+wdims[1],dims[1]-1)) # s = start, e = exit
+        groups.setdefault((xe-xs, ye-ys), []).append((i, xs, xe, ys, ye))
+    return groups
+
+
+class PreparedTemplate(object):
+    """
+        Everything computed from the template for the correction of a frame.
+        It is built once each time the template is updated in normcorre instead of once per frame :
+        -filtered : the cropped template filtered for global_correct
+        -coarse : the whole template filtered and downsampled by 2**pyramid_levels for get_search_window
+        -patches : for each shape of patch, the positions, the filtered tiles and their spectra for get_patch_shifts
+        The spectra are in the precision of the registration (parameter registration_dtype, complex64 for float32).
+    """
+
+    def __init__(self, template, dims, parameters):
+        self.dims       = tuple(dims)
+        self.template   = np.asarray(template, dtype = np.float32).reshape(self.dims)
+        self.nb_patches = len(get_patches_position(self.dims, **parameters)[0])
+        max_dev         = parameters['max_deviation_rigid']
+        self.filtered   = low_pass_filter_space(self.template[max_dev:-max_dev,max_dev:-max_dev].copy(), parameters['filter_size'])
+        filtered        = low_pass_filter_space(self.template.copy(), parameters['filter_size'])
+        self.dtype      = np.dtype(parameters.get('registration_dtype', 'float32'))
+        self.coarse     = downsample_image(filtered, parameters.get('pyramid_levels', 0))
+        self.patches    = []
+        for shape, patches in get_patch_groups(self.dims, parameters).items():
+            tiles       = np.array([low_pass_filter_space(self.template[xs:xe,ys:ye].copy(), parameters['filter_size_patch']) for i, xs, xe, ys, ye in patches])
+            spectra     = (np.fft.rfft2(tiles) / np.prod(shape)).astype(np.result_type(self.dtype, np.complex64))
+            self.patches.append((patches, tiles, spectra))
+
+
+def get_prepared_template(template, dims, parameters):
+    """ Return the template as a PreparedTemplate """
+    if isinstance(template, PreparedTemplate):
+        return template
+    return PreparedTemplate(template, dims, parameters)
+
+
+def get_patch_shifts(images, template, dims, parameters):
+    """ Register every patch of a group of images on the template.
+    The patches with the same shape are stacked and registered at once for all the images with register_translation_batch.
+
+    Parameters:
+    -images : ndarray (n, h*w) or (n, h, w)
+    -template : ndarray (h,w) or PreparedTemplate
+    -dims : dimension (h,w) of each frame
+    -parameters : dict of the motion correction
+
+    Returns:
+    -shifts_patch : ndarray (n, number of patches, 2), the shift of each patch in order Y,X"""
+
+    images          = np.asarray(images).reshape((-1,)+tuple(dims))
+    template        = get_prepared_template(template, dims, parameters)
+
+    shifts_patch    = np.zeros((len(images), template.nb_patches, 2))
+    for patches, tiles, spectra in template.patches:
+        index               = [i for i, xs, xe, ys, ye in patches]
+        filtered_images     = np.array([[low_pass_filter_space(image[xs:xe,ys:ye].copy(), parameters['filter_size_patch']) for i, xs, xe, ys, ye in patches] for image in images])
+        shifts_patch[:,index], phasediff = register_translation_batch(None, filtered_images, parameters['upsample_factor'], parameters['max_shifts'], src_freq = spectra, dtype = template.dtype)
+
+    return shifts_patch
+
+
+def tile_and_correct(image, template, dims, parameters, shifts_patch = None):
     """ perform piecewise rigid motion correction iteration, by
         1) dividing the FOV in patches
-        2) motion correcting each patch separately
+        2) motion correcting each patch separately (see get_patch_shifts, the shifts can be given if already computed)
         3) upsampling the motion correction vector field
-        4) stiching back together the corrected subpatches"""            
+        4) stiching back together the corrected subpatches
+        or with the parameter apply_mode = 'remap', warping the whole image with the vector field (see apply_shift_field)"""            
         
     image           = image.reshape(dims)    
-    template_uncrop = template.copy()
-    template        = template.reshape(dims)
 
     # extract patches positions
-    patches_index, wdims, pdims    = get_patches_position(dims, **parameters)
+    geometry        = get_patch_geometry(dims, parameters)
+    patches_index, wdims, pdims    = geometry.patches_index, geometry.wdims, geometry.pdims
 
     # extract shifts for each patch
-    shifts_patch = np.zeros((len(patches_index),2))
-    for i,patch_pos in enumerate(patches_index):
-        xs, xe, ys, ye = (patch_pos[0],np.minimum(patch_pos[0]+wdims[0],dims[0]-1),patch_pos[1],np.minimum(patch_pos[1]+wdims[1],dims[1]-1)) # s = start, e = exit
-        filtered_image = low_pass_filter_space(image[xs:xe,ys:ye].copy(), parameters['filter_size_patch'])
-        filtered_template = low_pass_filter_space(template[xs:xe,ys:ye].copy(), parameters['filter_size_patch'])
-        shifts_patch[i], error, phasediff = register_translation(filtered_template, filtered_image, parameters['upsample_factor'],"real",None,None, parameters['max_shifts']) #coordinate given back in order Y,X
+    if shifts_patch is None:
+        shifts_patch = get_patch_shifts(image[None], template, dims, parameters)[0]
 
     # create a vector field    
     shift_img_x     = shifts_patch[:,0].reshape(pdims)
@@ -414,33 +923,21 @@ def tile_and_correct(image, template, dims, parameters):
 
 
     # upsampling 
-    new_overlaps    = parameters['overlaps']
-    new_strides     = tuple(np.round(np.divide(parameters['strides'], parameters['upsample_factor_grid'])).astype(np.int))
-    upsamp_patches_index, upsamp_wdims, upsamp_pdims = get_patches_position(dims, new_strides, new_overlaps)
+    new_overlaps    = geometry.new_overlaps
+    new_strides     = geometry.new_strides
+    upsamp_patches_index, upsamp_wdims, upsamp_pdims = geometry.upsamp_patches_index, geometry.upsamp_wdims, geometry.upsamp_pdims
 
     # resize shift_img_
     shift_img_x     = cv2.resize(shift_img_x, (upsamp_pdims[1],upsamp_pdims[0]), interpolation = cv2.INTER_CUBIC)
     shift_img_y     = cv2.resize(shift_img_y, (upsamp_pdims[1],upsamp_pdims[0]), interpolation = cv2.INTER_CUBIC)
 
-    #create vector field
-    x= np.zeros(upsamp_pdims[1])
-    y= np.zeros(upsamp_pdims[0])
-    for i in range(0,upsamp_pdims[1]):
-        x[i]= new_strides[1]*i + upsamp_wdims[1]/2
-    for j in range(0,upsamp_pdims[0]):
-        y[j]= new_strides[0]*j + upsamp_wdims[0]/2
-    X,Y = np.meshgrid(x,y)
+    # one warp of the whole image instead of the correction and the blending of each patch
+    if parameters.get('apply_mode', 'patches') == 'remap':
+        if np.all(shift_img_x == 0) and np.all(shift_img_y == 0):
+            return image.flatten()
+        return apply_shift_field(image, shift_img_x, shift_img_y, geometry).flatten()
 
-    U_flat= np.ravel(shift_img_y.copy())
-    V_flat = np.ravel(shift_img_x.copy())
-    for i, uf in enumerate(U_flat):
-        if uf == 0 and V_flat[i] == 0 :
-            U_flat[i] = None
-            V_flat[i] = None
-
-        
-    U = U_flat.reshape(upsamp_pdims)
-    V = V_flat.reshape(upsamp_pdims)
+    # the vector field of the shifts is only needed for the figures (see vector_field)
 
     #apply shift iteration
     num_tiles           = np.prod(upsamp_pdims) #number of patches
@@ -456,7 +953,6 @@ def tile_and_correct(image, template, dims, parameters):
             new_upsamp_patches[i,0:patch.shape[0],0:patch.shape[1]] = patch.copy()
 
 
-    normalizer      = np.ones_like(image)
     new_image       = np.copy(image)    
     med             = np.median(new_image)
 
@@ -464,71 +960,9 @@ def tile_and_correct(image, template, dims, parameters):
         return new_image.flatten()
     else:
         if max_shear < 0.5:                        
-            np.seterr(all='raise')
-            # create weight matrix for blending
-            # different from original.    
-            # plus the blending func is dependant of the border.
-
-            tmp             = np.ones(upsamp_wdims)    
-            tmp[:new_overlaps[0], :] = np.linspace(0, 1, new_overlaps[0])[:, None]
-            corner          = np.flip(tmp, 0) * np.rot90(tmp, -1)
-            tmp             = tmp*np.flip(tmp, 0)
-            tmp2             = np.ones(upsamp_wdims)    
-            tmp2[:, :new_overlaps[1]] = np.linspace(0, 1, new_overlaps[1])[None, :]
-            tmp2            = tmp2*np.flip(tmp2, 1)
-            blending_func   = tmp*tmp2        
-            upper_band       = np.ones(upsamp_wdims)    
-            upper_band[-new_overlaps[0]:,:] = np.linspace(1, 0, new_overlaps[0])[:, None]
-            upper_band = np.rot90(upper_band, -1)*upper_band*np.rot90(upper_band, 1)
-            left_band = np.rot90(upper_band, 1)
-
-            
-            for i, patch_pos in enumerate(upsamp_patches_index):            
-                xs, xe, ys, ye = (patch_pos[0],patch_pos[0]+upsamp_wdims[0],patch_pos[1],patch_pos[1]+upsamp_wdims[1])        
-                ye = np.minimum(ye, new_image.shape[1])
-                xe = np.minimum(xe, new_image.shape[0])
-                prev_norm  = np.copy(normalizer[xs:xe,ys:ye])
-                prev_val    = np.copy(new_image[xs:xe,ys:ye])
-                new_val = np.copy(new_upsamp_patches[i,xs-patch_pos[0]:xe-patch_pos[0],ys-patch_pos[1]:ye-patch_pos[1]])
-
-                if xs != 0 and ys != 0 and xe != new_image.shape[0] and ye != new_image.shape[1]:
-                    tmp2 = blending_func[xs-patch_pos[0]:xe-patch_pos[0],ys-patch_pos[1]:ye-patch_pos[1]]
-                    normalizer[xs:xe,ys:ye] = np.nansum(np.dstack([~np.isnan(new_val)*1*tmp2, prev_norm]),-1)
-                    new_image[xs:xe,ys:ye] = np.nansum(np.dstack([new_val*tmp2, prev_val]),-1)
-                elif xs == 0 and ys == 0: # upper left corner                
-                    normalizer[xs:xe,ys:ye] = np.nansum(np.dstack([~np.isnan(new_val)*1*corner, prev_norm]),-1)
-                    new_image[xs:xe,ys:ye] = np.nansum(np.dstack([new_val*corner, prev_val]),-1)
-                elif xs == 0 and ye == new_image.shape[1]: # upper right corner
-                    tmp3 = np.rot90(corner, -1)[xs-patch_pos[0]:xe-patch_pos[0],ys-patch_pos[1]:ye-patch_pos[1]]
-                    normalizer[xs:xe,ys:ye] = np.nansum(np.dstack([~np.isnan(new_val)*1*tmp3, prev_norm]),-1)
-                    new_image[xs:xe,ys:ye] = np.nansum(np.dstack([new_val*tmp3, prev_val]),-1)
-                elif xe == new_image.shape[0] and ys == 0: # lower left corner                
-                    tmp3 = np.rot90(corner, 1)[xs-patch_pos[0]:xe-patch_pos[0],ys-patch_pos[1]:ye-patch_pos[1]]
-                    normalizer[xs:xe,ys:ye] = np.nansum(np.dstack([~np.isnan(new_val)*1*tmp3, prev_norm]),-1)
-                    new_image[xs:xe,ys:ye] = np.nansum(np.dstack([new_val*tmp3, prev_val]),-1)
-                elif xe == new_image.shape[0] and ye == new_image.shape[1]: # lower right corner
-                    tmp3 = np.rot90(corner, 2)[xs-patch_pos[0]:xe-patch_pos[0],ys-patch_pos[1]:ye-patch_pos[1]]               
-                    normalizer[xs:xe,ys:ye] = np.nansum(np.dstack([~np.isnan(new_val)*1*tmp3, prev_norm]),-1)
-                    new_image[xs:xe,ys:ye] = np.nansum(np.dstack([new_val*tmp3, prev_val]),-1)
-                elif xs == 0: # upper
-                    tmp3 = upper_band[xs-patch_pos[0]:xe-patch_pos[0],ys-patch_pos[1]:ye-patch_pos[1]]                
-                    normalizer[xs:xe,ys:ye] = np.nansum(np.dstack([~np.isnan(new_val)*1*tmp3, prev_norm]),-1)
-                    new_image[xs:xe,ys:ye] = np.nansum(np.dstack([new_val*tmp3, prev_val]),-1)
-                elif xe == new_image.shape[0]: # lower
-                    tmp3 = np.flip(upper_band, 0)[xs-patch_pos[0]:xe-patch_pos[0],ys-patch_pos[1]:ye-patch_pos[1]]  
-                    normalizer[xs:xe,ys:ye] = np.nansum(np.dstack([~np.isnan(new_val)*1*tmp3, prev_norm]),-1)
-                    new_image[xs:xe,ys:ye] = np.nansum(np.dstack([new_val*tmp3, prev_val]),-1)
-                elif ys == 0: # left
-                    tmp3 = left_band[xs-patch_pos[0]:xe-patch_pos[0],ys-patch_pos[1]:ye-patch_pos[1]]
-                    normalizer[xs:xe,ys:ye] = np.nansum(np.dstack([~np.isnan(new_val)*1*tmp3, prev_norm]),-1)
-                    new_image[xs:xe,ys:ye] = np.nansum(np.dstack([new_val*tmp3, prev_val]),-1)
-                elif ye == new_image.shape[1]: # right
-                    tmp3 = np.flip(left_band, 1)[xs-patch_pos[0]:xe-patch_pos[0],ys-patch_pos[1]:ye-patch_pos[1]]
-                    normalizer[xs:xe,ys:ye] = np.nansum(np.dstack([~np.isnan(new_val)*1*tmp3, prev_norm]),-1)
-                    new_image[xs:xe,ys:ye] = np.nansum(np.dstack([new_val*tmp3, prev_val]),-1)
-            
-            
-            new_image = new_image/normalizer
+            # blending of the patches with weights that depend on the border (see PatchGeometry)
+            with np.errstate(all='raise'):
+                new_image = geometry.blend(new_image, new_upsamp_patches)
 
         else:        
             half_overlap_x = np.int(new_overlaps[0] / 2)
@@ -580,18 +1014,62 @@ def global_correct(image, template, dims, parameters):
     """ 
         Do a global correction of the image """
 
+    # apply shift using subpixels adjustement
+    new_image = apply_rigid_shift(image.reshape(dims), get_global_shift(image, template, dims, parameters), dims)
+
+    return new_image.flatten()  
+
+
+def downsample_image(image, levels):
+    """ Downsample an image by 2**levels with cv2.pyrDown (gaussian smoothing and one pixel out of two) """
+    for level in range(levels):
+        image = cv2.pyrDown(image)
+    return image
+
+
+def get_search_window(filtered_image, template, max_dev, levels):
+    """ Offsets of the template matched at full resolution by get_global_shift.
+    Without pyramid, every offset from 0 to 2*max_dev. With levels > 0, the image and the template are downsampled by 2**levels,
+    matched over the whole range of offsets at this scale and only the offsets at less than 2**levels pixels of the coarse shift
+    are kept, so that the cost does not grow with max_dev.
+
+    Parameters:
+    -filtered_image : ndarray (h,w), the image filtered as the template
+    -template : PreparedTemplate
+    -max_dev : max_deviation_rigid
+    -levels : number of levels of the pyramid
+
+    Returns:
+    -row_lo, row_hi, col_lo, col_hi : the first and the last offset on the rows and on the columns"""
+
+    scale       = 2**levels
+    if levels <= 0 or max_dev <= scale:
+        return 0, 2*max_dev, 0, 2*max_dev
+    max_dev_c   = int(np.ceil(max_dev / scale))
+    res         = cv2.matchTemplate(downsample_image(filtered_image, levels), template.coarse[max_dev_c:-max_dev_c,max_dev_c:-max_dev_c], cv2.TM_CCOEFF_NORMED)
+    col_c, row_c = cv2.minMaxLoc(res)[3]
+    row, col    = max_dev + (row_c - max_dev_c)*scale, max_dev + (col_c - max_dev_c)*scale
+    return tuple(int(np.clip(o, 0, 2*max_dev)) for o in (row - scale, row + scale, col - scale, col + scale))
+
+
+def get_global_shift(image, template, dims, parameters):
+    """ Rigid shift of the image found by matching the filtered image on the filtered template (see global_correct)
+
+    Returns:
+    -shift : (shift of the rows, shift of the columns)"""
+
     max_dev = parameters['max_deviation_rigid']
     
     image           = image.reshape(dims)    
-    template_uncrop = template.copy()
-    template        = template_uncrop[max_dev:-max_dev,max_dev:-max_dev]
+    template        = get_prepared_template(template, dims, parameters)
 
-    # filter the image and the template with a large filter 
+    # filter the image with a large filter. The template is filtered in PreparedTemplate
     filtered_image = low_pass_filter_space(image.copy(), parameters['filter_size'])
-    filtered_template = low_pass_filter_space(template.copy(), parameters['filter_size'])
+    filtered_template = template.filtered
 
-    # call opencv match template    
-    res = cv2.matchTemplate(filtered_image, filtered_template, cv2.TM_CCOEFF_NORMED)  
+    # call opencv match template on the offsets of the search window (all of them without pyramid_levels)
+    row_lo, row_hi, col_lo, col_hi = get_search_window(filtered_image, template, max_dev, parameters.get('pyramid_levels', 0))
+    res = cv2.matchTemplate(filtered_image[row_lo:row_hi+filtered_template.shape[0],col_lo:col_hi+filtered_template.shape[1]], filtered_template, cv2.TM_CCOEFF_NORMED)  
     avg_metric = np.mean(res)
     top_left = cv2.minMaxLoc(res)[3] #get the maximum location
 
@@ -599,9 +1077,9 @@ def global_correct(image, template, dims, parameters):
     # FROM PYFLUO https://github.com/bensondaled/pyfluo
     ## from here x and y are reversed in naming convention 
     sh_y,sh_x = top_left
+    ms_h, ms_w = max_dev - row_lo, max_dev - col_lo # position of the null shift in res
     
-    if (0 < top_left[1] < 2 * max_dev-1) and (0 < top_left[0] < 2 * max_dev-1):
-        ms_h = ms_w = max_dev
+    if (0 < sh_x + row_lo < 2 * max_dev-1) and (0 < sh_y + col_lo < 2 * max_dev-1) and (0 < sh_x < res.shape[0]-1) and (0 < sh_y < res.shape[1]-1):
         # if max is internal, check for subpixel shift using gaussian peak registration        
         log_xm1_y = np.log(res[sh_x-1,sh_y])          
         log_xp1_y = np.log(res[sh_x+1,sh_y])             
@@ -611,44 +1089,503 @@ def global_correct(image, template, dims, parameters):
         sh_x_n = -(sh_x - ms_h + (log_xm1_y - log_xp1_y) / (2 * log_xm1_y - four_log_xy + 2 * log_xp1_y))
         sh_y_n = -(sh_y - ms_w + (log_x_ym1 - log_x_yp1) / (2 * log_x_ym1 - four_log_xy + 2 * log_x_yp1))
     else:
-        sh_x_n = -(sh_x - max_dev)
-        sh_y_n = -(sh_y - max_dev)    
-    
-    # apply shift using subpixels adjustement
+        sh_x_n = -(sh_x - ms_h)
+        sh_y_n = -(sh_y - ms_w)    
+
+    return sh_x_n, sh_y_n
+
+
+def apply_rigid_shift(image, shift, dims):
+    """ Shift the whole image with a linear interpolation as in global_correct
+
+    Parameters:
+    -image : ndarray (h,w)
+    -shift : (shift of the rows, shift of the columns)
+    -dims : dimension (h,w) of the image
+
+    Returns:
+    -new_image : ndarray (h,w)"""
+
     interpolation = cv2.INTER_LINEAR
-    M   = np.float32([[1, 0, sh_y_n], [0, 1, sh_x_n]])
+    M   = np.float32([[1, 0, shift[1]], [0, 1, shift[0]]])
     min_, max_ = np.min(image), np.max(image)
-    new_image = cv2.warpAffine(image, M, dims[::-1], flags = interpolation, borderMode=cv2.BORDER_REFLECT) 
-    new_image = np.clip(new_image, min_, max_)
+    new_image = cv2.warpAffine(image, M, tuple(dims[::-1]), flags = interpolation, borderMode=cv2.BORDER_REFLECT) 
+    return np.clip(new_image, min_, max_)
 
-    return new_image.flatten()  
+
+def get_shear(shifts_patch, pdims):
+    """ Shear of the shifts of the patches of each image, computed as max_shear in tile_and_correct on the grid of the patches.
+    It is 0 when every patch moves with the whole image.
+
+    Parameters:
+    -shifts_patch : ndarray (n, number of patches, 2)
+    -pdims : (number of patches on the height, number of patches on the width)
+
+    Returns:
+    -shear : ndarray (n,)"""
+
+    shear       = np.zeros(len(shifts_patch))
+    for i, shifts in enumerate(shifts_patch):
+        diffs   = [np.max(np.abs(np.diff(s.reshape(pdims), axis = a))) for s, a in itertools.product([shifts[:,0], shifts[:,1]], [0, 1]) if pdims[a] > 1]
+        shear[i] = np.percentile(diffs, 75) if len(diffs) else 0.0
+    return shear
+
+
+def get_correlation(frames, template):
+    """ Correlation coefficient of each frame with the template
+
+    Parameters:
+    -frames : ndarray (n, h*w)
+    -template : ndarray (h,w)
+
+    Returns:
+    -corr : ndarray (n,), nan for a constant frame"""
+
+    frames      = np.asarray(frames, dtype = np.float32).reshape(len(frames), -1)
+    template    = np.asarray(template, dtype = np.float32).ravel()
+    template    = template - template.mean()
+    frames      = frames - frames.mean(1, keepdims = True)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        return frames.dot(template) / (np.linalg.norm(frames, axis = 1) * np.linalg.norm(template))
+
+
+def get_residual_shear(images, template, dims, parameters):
+    """ Shear of the shifts of the patches left after the global correction of each image (see get_shear)
+
+    Returns:
+    -shear : ndarray (n,)"""
+
+    template    = get_prepared_template(template, dims, parameters)
+    images_glob = np.array([global_correct(img, template, dims, parameters) for img in images])
+    shifts_patch = get_patch_shifts(images_glob, template, dims, parameters)
+    return get_shear(shifts_patch, get_patch_geometry(dims, parameters).pdims)
+
+
+def get_correction_mode(movie, template, dims, parameters):
+    """ Return the mode of the motion correction : 'rigid' or 'piecewise'.
+    With the mode 'auto', the residual shear is measured on auto_sample frames spread over the movie and the piecewise
+    correction is used only if its median is above shear_threshold pixels. The shifts of the patches are found on a grid
+    of 1/upsample_factor pixel, so a shear of one step of the grid is not enough and the threshold is at least one step."""
+
+    mode = parameters.get('mode', 'piecewise')
+    if mode != 'auto':
+        return mode
+    index   = np.unique(np.linspace(0, len(movie)-1, min(parameters.get('auto_sample', 50), len(movie))).astype(int))
+    frames  = FloatDataset(movie)[index]
+    shear   = np.median(get_residual_shear(frames, template, dims, parameters))
+    threshold = max(parameters.get('shear_threshold', 0.5), 1.0/parameters['upsample_factor'])
+    return 'piecewise' if shear > threshold else 'rigid'
 
 
 def make_corrections(images, template, dims, parameters): 
-    ''' Do a global and a loc correction of a cluster of images'''
+    ''' Do a global and a loc correction of a cluster of images
+    The patches of every image are registered at once after the global correction (see estimate_shifts)
+    With the mode 'rigid', only a rigid correction is done
+    The shifts are returned with the images for the QC datasets of normcorre (see get_motion_datasets)'''
+
+    template = get_prepared_template(template, dims, parameters)
+    images_glob, shifts_rigid, shifts_patch = estimate_shifts(images, template, dims, parameters)
+    if parameters.get('mode', 'piecewise') != 'rigid':
+        for i, img_glob in enumerate(images_glob):
+            img_loc = tile_and_correct(img_glob, template, dims, parameters, shifts_patch[i])        
+            images[i] = img_loc
+    return images, shifts_rigid, shifts_patch
+
 
+def estimate_shifts(images, template, dims, parameters):
+    """ Estimate the shifts of a cluster of images as make_corrections but without the correction of the patches.
+    The images are replaced by their rigid correction, which is used to update the template in the deferred mode of normcorre.
+
+    Returns:
+    -images : the images after the rigid correction
+    -shifts_rigid : ndarray (n, 2), the rigid shift of each image
+    -shifts_patch : ndarray (n, number of patches, 2), the shifts of the patches after the rigid correction (0 with the mode 'rigid')"""
+
+    template        = get_prepared_template(template, dims, parameters)
+    shifts_rigid    = np.zeros((len(images), 2))
+    shifts_patch    = np.zeros((len(images), template.nb_patches, 2))
+    if len(images) == 0:
+        return images, shifts_rigid, shifts_patch
+    shifts_rigid    = np.array([get_global_shift(img, template, dims, parameters) for img in images])
     for i, img in enumerate(images):
-        img_glob = global_correct(img, template, dims, parameters)
-        img_loc = tile_and_correct(img_glob, template, dims, parameters)        
-        images[i] = img_loc
+        images[i] = apply_rigid_shift(np.asarray(img, dtype = np.float32).reshape(dims), shifts_rigid[i], dims).flatten()
+    if parameters.get('mode', 'piecewise') != 'rigid':
+        shifts_patch = get_patch_shifts(images, template, dims, parameters)
+    return images, shifts_rigid, shifts_patch
+
+
+def apply_shifts(images, shifts, dims, parameters):
+    """ Correct a cluster of images with the shifts found by estimate_shifts : the rigid shift and then the shifts of the patches.
+
+    Parameters:
+    -images : ndarray (n, h*w)
+    -shifts : (shifts_rigid, shifts_patch) of the images
+    -dims : dimension (h,w) of each frame
+    -parameters : dict of the motion correction
+
+    Returns:
+    -images : the corrected images"""
+
+    shifts_rigid, shifts_patch = shifts
+    for i, img in enumerate(images):
+        new_image = apply_rigid_shift(np.asarray(img, dtype = np.float32).reshape(dims), shifts_rigid[i], dims)
+        if parameters.get('mode', 'piecewise') != 'rigid':
+            new_image = tile_and_correct(new_image, None, dims, parameters, shifts_patch[i])
+        images[i] = new_image.flatten()
     return images
 
 
-def map_function(procs, nb_splits, chunk_movie, template, dims, parameters): 
-    ''' Do multiprocessing'''    
+def map_function(procs, nb_splits, chunk_movie, template, dims, parameters, function = make_corrections): 
+    ''' Do multiprocessing
+    The function is make_corrections, estimate_shifts or apply_shifts. The template can be a list with one item for each split (the shifts for apply_shifts)'''    
 
+    templates = template if isinstance(template, list) else [template]*nb_splits
     if procs is not None:
-        pargs = zip(chunk_movie, [template]*nb_splits, [dims]*nb_splits, [parameters]*nb_splits)
+        pargs = zip(chunk_movie, templates, [dims]*nb_splits, [parameters]*nb_splits)
         if 'multiprocessing' in str(type(procs)):
-            tmp = procs.starmap_async(make_corrections, pargs).get() 
+            tmp = procs.starmap_async(function, pargs).get() 
         else:
-            tmp = procs.starmap_sync(make_corrections, pargs)            
+            tmp = procs.starmap_sync(function, pargs)            
             procs.results.clear()                    
     else:
-        tmp = list(map(make_corrections, chunk_movie, [template]*nb_splits, [dims]*nb_splits, [parameters]*nb_splits))
+        tmp = list(map(function, chunk_movie, templates, [dims]*nb_splits, [parameters]*nb_splits))
 
     return tmp
 
+
+def get_pool_size(procs):
+    """ Number of processes of the pool, 1 without pool """
+    if procs is None:
+        return 1
+    if hasattr(procs, '_processes'): # multiprocessing pool
+        return int(procs._processes)
+    if hasattr(procs, '__len__'): # view of a cluster
+        return max(len(procs), 1)
+    return os.cpu_count()
+
+
+class TaskScheduler(object):
+    """
+        Number of tasks each chunk of frames is split in for the pool (nb_splits).
+        A task has about frames_per_task frames until the time to correct a frame is measured, then as many frames as
+        can be corrected in task_time seconds so that the cost of sending a task stays small compared to its correction.
+        The number of tasks is a multiple of the number of processes of the pool so that every process has the same work.
+        Without pool, a chunk is corrected in one task.
+    """
+
+    def __init__(self, procs, frames_per_task = 8, task_time = 0.5):
+        self.nb_workers         = get_pool_size(procs)
+        self.frames_per_task    = max(int(frames_per_task), 1)
+        self.task_time          = task_time
+        self.frame_time         = None # time to correct one frame by one process
+
+    def get_nb_splits(self, nb_frames):
+        if self.nb_workers == 1 or nb_frames <= 1:
+            return 1
+        frames_per_task = self.frames_per_task
+        if self.frame_time is not None:
+            frames_per_task = max(int(self.task_time / self.frame_time), 1)
+        nb_splits = self.nb_workers * max(int(np.round(nb_frames / frames_per_task / self.nb_workers)), 1)
+        return int(min(nb_splits, nb_frames))
+
+    def update(self, nb_frames, nb_splits, elapsed):
+        """ Update the time to correct one frame with the time of a chunk of nb_frames frames split in nb_splits tasks """
+        if nb_frames == 0:
+            return
+        frame_time = elapsed * min(self.nb_workers, nb_splits) / nb_frames
+        self.frame_time = frame_time if self.frame_time is None else 0.5*(self.frame_time + frame_time)
+
+
+class SharedFrames(object):
+    """
+        Frames of chunks of the movie and template in shared memory for the workers of a multiprocessing pool.
+        The chunks are read from the file directly in the shared buffers, the workers correct their frames in place
+        and only the names of the buffers and the index of the frames are sent to them (see map_shared).
+        There are nb_buffers buffers of nb_frames frames so that chunks can be read and written while another one is corrected (see ChunkPipeline).
+        The template has a version number so that each worker prepares it only once (see get_shared_template).
+    """
+
+    def __init__(self, nb_frames, dims, nb_buffers = 1):
+        self.dims           = tuple(dims)
+        self.shape          = (int(nb_buffers), int(nb_frames), int(np.prod(dims)))
+        self.frames_memory  = shared_memory.SharedMemory(create = True, size = int(np.prod(self.shape))*4)
+        self.frames         = np.ndarray(self.shape, dtype = np.float32, buffer = self.frames_memory.buf)
+        self.template_memory = shared_memory.SharedMemory(create = True, size = self.shape[2]*4)
+        self.template       = np.ndarray(self.dims, dtype = np.float32, buffer = self.template_memory.buf)
+        self.version        = 0
+
+    def set_template(self, template):
+        self.template[:]    = template
+        self.version        += 1
+
+    def close(self):
+        del self.frames, self.template
+        for memory in [self.frames_memory, self.template_memory]:
+            memory.close()
+            memory.unlink()
+
+
+_shared_buffers = {} # shared memory attached by a worker
+_inherited_tracker = [] # whether the worker was forked after the resource tracker of the main process started
+_shared_templates = {} # template prepared by a worker for each version
+
+def attach_shared_array(name, shape, dtype = np.float32):
+    """ Return the array of a shared memory of SharedFrames. The memory is attached once by each process.
+    The memory is only tracked by the main process that unlinks it : a worker that does not share the resource tracker
+    of the main process would unlink it or warn about a leak when it stops."""
+    if name not in _shared_buffers:
+        try:
+            _shared_buffers[name] = shared_memory.SharedMemory(name = name, track = False) # python >= 3.13
+        except TypeError:
+            if len(_inherited_tracker) == 0:
+                _inherited_tracker.append(resource_tracker._resource_tracker._fd is not None)
+            _shared_buffers[name] = shared_memory.SharedMemory(name = name)
+            if not _inherited_tracker[0]:
+                resource_tracker.unregister(_shared_buffers[name]._name, 'shared_memory')
+    return np.ndarray(shape, dtype = dtype, buffer = _shared_buffers[name].buf)
+
+
+def release_shared_buffers(keep):
+    """ Close the shared memory of the previous runs of normcorre attached by a worker """
+    for name in [n for n in _shared_buffers.keys() if n not in keep]:
+        _shared_buffers.pop(name).close()
+
+
+def get_shared_template(name, version, dims, parameters):
+    """ Return the PreparedTemplate of the shared template. It is prepared once by each process for each version """
+    if (name, version) not in _shared_templates:
+        _shared_templates.clear()
+        _shared_templates[(name, version)] = PreparedTemplate(np.array(attach_shared_array(name, dims)), dims, parameters)
+    return _shared_templates[(name, version)]
+
+
+def correct_shared_frames(frames_name, shape, template_name, version, buffer, start, end, dims, parameters, task = 'correct', shifts = None):
+    """ Correct in place the frames start to end of a buffer of chunk in shared memory and return their shifts (see make_corrections).
+    With task = 'estimate', the frames are only corrected with their rigid shift (see estimate_shifts).
+    With task = 'apply', the frames are corrected with the given shifts (see apply_shifts) """
+    release_shared_buffers([frames_name, template_name])
+    frames      = attach_shared_array(frames_name, shape)
+    if task == 'apply':
+        apply_shifts(frames[buffer,start:end], shifts, dims, parameters)
+        return shifts
+    template    = get_shared_template(template_name, version, dims, parameters)
+    function    = estimate_shifts if task == 'estimate' else make_corrections
+    return function(frames[buffer,start:end], template, dims, parameters)[1:]
+
+def correct_shared_frames_helper(args): return correct_shared_frames(*args)
+
+
+def map_shared(procs, shared, buffer, nb_frames, nb_splits, parameters, task = 'correct', shifts = None):
+    """ Correct the first nb_frames frames of a buffer of the SharedFrames on the multiprocessing pool.
+    See correct_shared_frames for the task and the shifts (shifts_rigid, shifts_patch) of the frames
+
+    Returns:
+    -frames : view of the corrected frames in shared memory
+    -results : the (shifts_rigid, shifts_patch) of each split"""
+
+    bounds  = np.linspace(0, nb_frames, nb_splits+1).astype(np.int)
+    args    = [(shared.frames_memory.name, shared.shape, shared.template_memory.name, shared.version, buffer, s, e, shared.dims, parameters, task,
+                None if shifts is None else (shifts[0][s:e], shifts[1][s:e])) for s, e in zip(bounds[:-1], bounds[1:]) if e > s]
+    results = procs.map(correct_shared_frames_helper, args)
+    return shared.frames[buffer,0:nb_frames], results
+
+
+class ChunkPipeline(object):
+    """
+        Read, correction and write of the chunks of the movie in three stages that overlap in time :
+        a reader thread reads the next chunks in the free buffers, the main thread corrects a chunk (on the pool) and
+        a writer thread writes the corrected chunks and gives their buffer back to the reader.
+        The queues are bounded by the number of buffers. Without thread, the chunks are read, corrected and written in sequence.
+        The time each stage is busy is accumulated to report its utilization (see utilization).
+
+        Use :
+        pipeline.start(starts)
+        for each chunk : start, buffer, frames = pipeline.get() ... pipeline.put(start, buffer, result of the correction)
+        pipeline.flush() waits for every corrected chunk to be written
+        pipeline.stop() waits for the threads to finish and raises the error of the writer
+        pipeline.close() only waits for the threads, when the correction failed. It does nothing if the pipeline is not running
+    """
+
+    def __init__(self, read, write, nb_buffers = 3, threaded = True):
+        """
+        Parameters:
+        -read : function (start, buffer) returning the frames of the chunk read in the buffer
+        -write : function (start, result) writing the result of the correction of the chunk given to put
+        -nb_buffers : number of buffers of chunk
+        -threaded : bool, use the reader and writer threads"""
+        self.read       = read
+        self.write      = write
+        self.nb_buffers = nb_buffers
+        self.threaded   = threaded
+        self.busy       = OrderedDict([('read', 0.), ('correct', 0.), ('write', 0.)])
+        self.elapsed    = 0.
+        self.running    = False
+
+    def start(self, starts):
+        self.starts     = list(starts)
+        self.position   = 0
+        self.error      = None
+        self.begin      = time.time()
+        self.running    = True
+        if self.threaded:
+            self.free       = queue.Queue()
+            for buffer in range(self.nb_buffers):
+                self.free.put(buffer)
+            self.ready      = queue.Queue(maxsize = self.nb_buffers)
+            self.corrected  = queue.Queue(maxsize = self.nb_buffers)
+            self.reader     = threading.Thread(target = self.read_loop, daemon = True)
+            self.writer     = threading.Thread(target = self.write_loop, daemon = True)
+            self.reader.start()
+            self.writer.start()
+
+    def read_loop(self):
+        try:
+            for start in self.starts:
+                buffer = self.free.get()
+                if buffer is None: # the pipeline is stopped
+                    return
+                begin = time.time()
+                frames = self.read(start, buffer)
+                self.busy['read'] += time.time() - begin
+                self.ready.put((start, buffer, frames))
+        except Exception as error:
+            self.ready.put(error)
+
+    def write_loop(self):
+        while True:
+            item = self.corrected.get()
+            if item is None:
+                self.corrected.task_done()
+                return
+            start, buffer, frames = item
+            try:
+                if self.error is None:
+                    begin = time.time()
+                    self.write(start, frames)
+                    self.busy['write'] += time.time() - begin
+            except Exception as error:
+                self.error = error
+            self.free.put(buffer)
+            self.corrected.task_done()
+
+    def get(self):
+        """ Return the next chunk read as (start, buffer, frames) """
+        if self.threaded:
+            item = self.ready.get()
+            if isinstance(item, Exception):
+                raise item
+        else:
+            begin = time.time()
+            item = (self.starts[self.position], 0, self.read(self.starts[self.position], 0))
+            self.busy['read'] += time.time() - begin
+        self.position += 1
+        self.correct_begin = time.time()
+        return item
+
+    def put(self, start, buffer, frames):
+        """ Give the corrected frames of a chunk, or any result of its correction, to be written """
+        self.busy['correct'] += time.time() - self.correct_begin
+        if self.threaded:
+            self.corrected.put((start, buffer, frames))
+        else:
+            begin = time.time()
+            self.write(start, frames)
+            self.busy['write'] += time.time() - begin
+
+    def flush(self):
+        """ Wait for every corrected chunk to be written """
+        if self.threaded:
+            self.corrected.join()
+        if self.error is not None:
+            raise self.error
+
+    def stop(self):
+        """ Wait for the threads to finish and raise the error of the writer if there was one """
+        self.close()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        """ Wait for the threads to finish without raising the error of the writer, when the correction failed """
+        if not self.running:
+            return
+        self.running    = False
+        if self.threaded:
+            self.corrected.put(None)
+            self.writer.join()
+            self.free.put(None)
+            self.reader.join()
+        self.elapsed += time.time() - self.begin
+
+    def utilization(self):
+        """ Return the fraction of the time each stage was busy """
+        return OrderedDict([(stage, busy / max(self.elapsed, 1e-9)) for stage, busy in self.busy.items()])
+
+
+def save_checkpoint(hdf_mov, nb_round, start_frame, template, correction_key):
+    """ Save the progress of the motion correction in the file so that it can be resumed with the parameter resume.
+    The round, the frame and the key of the parameters are attributes of the movie. The template is too big for an attribute and is saved in the dataset template.
+
+    Parameters:
+    -hdf_mov : the hdf5 file
+    -nb_round : the round in progress
+    -start_frame : the first frame of the next chunk to correct in this round
+    -template : ndarray, the current template
+    -correction_key : key of the parameters of the motion correction (see get_correction_key)"""
+
+    if 'template' not in hdf_mov.keys():
+        create_dataset(hdf_mov, 'template', shape = template.shape, dtype = np.float32)
+    hdf_mov['template'][:] = template
+    hdf_mov['movie'].attrs['mc_round'] = nb_round
+    hdf_mov['movie'].attrs['mc_frame'] = start_frame
+    hdf_mov['movie'].attrs['mc_checkpoint_key'] = correction_key
+    hdf_mov.flush()
+
+
+def clear_checkpoint(hdf_mov):
+    """ Remove the attributes of the checkpoint once the motion correction is finished. The template is kept in the file """
+    for key in ['mc_round', 'mc_frame', 'mc_checkpoint_key']:
+        if key in hdf_mov['movie'].attrs.keys():
+            del hdf_mov['movie'].attrs[key]
+
+
+def get_motion_datasets(hdf_mov, duration, dims, parameters, reset = True):
+    """ Return the group motion of the file with the quality control of the motion correction of each frame, filled by normcorre :
+    -shifts_rigid : (duration, 2), the rigid shift (see estimate_shifts)
+    -shifts_patch : (duration, number of patches, 2), the shifts of the patches after the rigid shift. The shape (h,w) of the grid
+    of patches is the attribute pdims
+    The shifts are the sum of the shifts of the rounds, since each round corrects the movie written by the previous one,
+    or the shifts of the last round with the parameter deferred. With several rounds, the sums of the rounds before the current one
+    are kept in shifts_rigid_previous and shifts_patch_previous so that a chunk corrected again after a resume is not added twice.
+    -corr : (duration,), the correlation of the corrected frame with the template used for its correction (see get_correlation)
+    -shear : (duration,), the shear of the shifts of the patches (see get_shear)
+    -active : (duration,), bool, with the parameter adaptive, the frames to correct again in the next round. It is read back to resume the correction
+    With reset, the datasets are created again."""
+
+    group       = hdf_mov.require_group('motion')
+    geometry    = get_patch_geometry(dims, parameters)
+    shapes      = {'shifts_rigid':(duration, 2), 'shifts_patch':(duration, len(geometry.patches_index), 2), 'corr':(duration,), 'shear':(duration,), 'active':(duration,)}
+    if parameters['nb_round'] > 1 and not parameters.get('deferred', False):
+        shapes.update(shifts_rigid_previous = shapes['shifts_rigid'], shifts_patch_previous = shapes['shifts_patch'])
+    options     = {'active':dict(dtype = bool, fillvalue = True)}
+    for name, shape in shapes.items():
+        if name in group.keys() and (reset or group[name].shape != shape):
+            del group[name]
+        if name not in group.keys():
+            create_dataset(group, name, shape = shape, **options.get(name, dict(dtype = np.float32)))
+    group['shifts_patch'].attrs['pdims'] = geometry.pdims
+    return group
+
+
+def get_checkpoint(hdf_mov, correction_key):
+    """ Return the round, the first frame of the next chunk and the template saved by save_checkpoint
+    or None if there is none or if it was saved with other parameters of the motion correction """
+    if 'movie' in hdf_mov.keys() and 'template' in hdf_mov.keys() and 'mc_round' in hdf_mov['movie'].attrs.keys() \
+            and hdf_mov['movie'].attrs.get('mc_checkpoint_key') == correction_key:
+        return int(hdf_mov['movie'].attrs['mc_round']), int(hdf_mov['movie'].attrs['mc_frame']), np.array(hdf_mov['template'][:])
+    return None
+
+
 def normcorre(fnames, procs, parameters):
     """
         see 
@@ -657,34 +1594,72 @@ def normcorre(fnames, procs, parameters):
         Journal of Neuroscience Methods, 291:83-92
         or 
         CaiMan github
+
+        With the parameter resume, the motion correction continues after the last chunk written in the file (see save_checkpoint)
+        instead of starting again from the avi files. A checkpoint saved with other parameters of the motion correction is ignored.
+        With the parameter cache, an existing motion_corrected.hdf5 made from the same videos (see get_ingest_key) is reused :
+        the file is returned as it is if the motion correction was finished with the same parameters, otherwise
+        the movie is copied again from the dataset original without decoding the videos.
+        With the parameter adaptive, the rounds after the first one only correct the frames that moved by more than recorrect_shift pixels
+        in the previous round. The other frames are not corrected nor written.
+        With the parameter template_update = 'running', the template is updated in memory from the corrected frames of each chunk
+        (see update_template) instead of the median of each block read back from the file.
+        The shifts, the correlation with the template and the shear of each frame are saved in the group motion (see get_motion_datasets).
+        With the parameter deferred, the rounds only estimate the shifts of the frames
+        and update the template from the frames with their rigid correction. The movie is corrected and written once at the end with the
+        shifts of the last round.
     """
     #################################################################################################
     # 1. Load every movies in only one file  or load the HDF if already present
     #################################################################################################
     video_info = None
+    checkpoint = None
+    hdf_mov = None
+    correction_key = get_correction_key(parameters)
     main_name, file_extension = os.path.splitext(fnames[0])    
     
     #fnames is the name of the file we will use 
     if file_extension == '.hdf5' : 
-        hdf_mov = hd.File(fnames[0], 'r+')
-        if 'original' in hdf_mov.keys():
-            duration = hdf_mov['original'].attrs['duration']
-            dims = tuple(hdf_mov['original'].attrs['dims'])
-
-            if 'movie' not in hdf_mov.keys():                
-                movie = hdf_mov.create_dataset('movie', shape = (duration, dims[0]*dims[1]), dtype = np.float32, chunks=True)
-            
-            size = hdf_mov['original'].chunks[0]
-            starts = np.arange(0, duration, size)
-            for i in starts:
-                hdf_mov['movie'][i:i+size] = hdf_mov['original'].value[i:i+size]
-
+        hdf_mov = open_file(fnames[0], 'r+')
+        if parameters.get('storage') is not None:
+            set_storage_options(hdf_mov, **parameters['storage'])
+        if parameters.get('cache', False) and 'movie' in hdf_mov.keys() and hdf_mov['movie'].attrs.get('mc_key') == correction_key:
+            update_tiled_copy(hdf_mov, parameters)
+            return hdf_mov, video_info
+        if parameters.get('resume', False): 
+            checkpoint = get_checkpoint(hdf_mov, correction_key)
+        if checkpoint is not None:
+            duration = hdf_mov['movie'].attrs['duration']
+            dims = tuple(hdf_mov['movie'].attrs['dims'])
+        elif 'original' in hdf_mov.keys():
+            dims, duration = copy_original(hdf_mov, parameters)
         else:
             print("The key of the movie should be called 'original'")
 
     elif file_extension == '.avi':
         video_info, videos, dims = get_video_info(fnames)
-        hdf_mov       = get_hdf_file(videos, video_info, dims, parameters['save_original'])
+        hdf_name = os.path.split(video_info.index.get_level_values(1)[0])[0] + '/' + 'motion_corrected.hdf5'
+        ingest_key = get_ingest_key(fnames, parameters)
+        if (parameters.get('resume', False) or parameters.get('cache', False)) and os.path.exists(hdf_name):
+            hdf_mov = open_file(hdf_name, 'r+')
+            same_videos = hdf_mov.attrs.get('ingest_key', ingest_key) == ingest_key
+            if parameters.get('cache', False) and 'ingest_key' in hdf_mov.attrs.keys() and same_videos:
+                if 'movie' in hdf_mov.keys() and hdf_mov['movie'].attrs.get('mc_key') == correction_key:
+                    update_tiled_copy(hdf_mov, parameters)
+                    return hdf_mov, video_info
+            if parameters.get('resume', False) and same_videos:
+                checkpoint = get_checkpoint(hdf_mov, correction_key)
+            if checkpoint is None and parameters.get('cache', False) and 'ingest_key' in hdf_mov.attrs.keys() and same_videos and 'original' in hdf_mov.keys():
+                copy_original(hdf_mov, parameters)
+            elif checkpoint is None:
+                hdf_mov.close()
+                hdf_mov = None
+        if hdf_mov is None:
+            hdf_mov   = get_hdf_file(videos, video_info, dims, parameters['save_original'], batch_size = parameters.get('ingest_batch_size', 100), procs = procs,
+                                movie_dtype = parameters.get('movie_dtype', 'float32'), original_dtype = parameters.get('original_dtype', 'float32'),
+                                storage = parameters.get('storage'), chunk_frames = parameters.get('chunk_frames'), backend = parameters.get('backend', 'hdf5'),
+                                copy_on_write = parameters.get('copy_on_write', False))
+            hdf_mov.attrs['ingest_key'] = ingest_key
         duration    = video_info['duration'].sum() 
 
     else : 
@@ -693,42 +1668,221 @@ def normcorre(fnames, procs, parameters):
 
     
     #################################################################################################
-    # 2. Estimate template from first n frame
+    # 2. Estimate template from first n frame or start from the checkpoint
     #################################################################################################
-    template   = get_template(hdf_mov['movie'], dims, start = 0, duration = 500)
+    if checkpoint is None:
+        if 'mc_key' in hdf_mov['movie'].attrs.keys():
+            del hdf_mov['movie'].attrs['mc_key']
+        if 'movie_tiled' in hdf_mov.keys(): # copy of the previous motion correction
+            del hdf_mov['movie_tiled']
+        hdf_mov['movie'].attrs['dims'] = dims
+        hdf_mov['movie'].attrs['duration'] = duration 
+        template   = get_template(get_source(hdf_mov), dims, start = 0, duration = 500)
+        start_round, start_frame = 0, 0
+        save_checkpoint(hdf_mov, start_round, start_frame, template, correction_key)
+    else:
+        start_round, start_frame, template = checkpoint
     
     #################################################################################################
     # 3. run motion correction / update template
     #################################################################################################    
      
-    chunk_size  = hdf_mov['movie'].chunks[0] 
+    # the number of frames corrected at once is a multiple of the number of frames in a chunk of the file
+    chunk_frames = hdf_mov['movie'].chunks[0]
+    chunk_size  = np.minimum(parameters.get('chunk_size', 64), parameters['block_size'])
+    chunk_size  = int(np.maximum(chunk_size//chunk_frames, 1)*chunk_frames)
     chunk_starts_glob = np.arange(0, duration, chunk_size)
-    nb_splits   = os.cpu_count() 
+    scheduler   = TaskScheduler(procs, parameters.get('frames_per_task', 8), parameters.get('task_time', 0.5))
 
     block_size = parameters['block_size'] 
     coeff_euc = block_size//chunk_size # how many whole chunk there is in a block
     new_block = chunk_size*coeff_euc
     block_starts = np.arange(0,duration,new_block) 
-       
-    for i in range(parameters['nb_round']): # loop on the movie
-        for start_block in tqdm(block_starts): # for each block
-            chunk_starts_loc = np.arange(start_block,start_block+new_block,chunk_size)
-            for start_chunk in chunk_starts_loc: # for each chunk                
-                chunk_movie = hdf_mov['movie'][start_chunk:start_chunk+chunk_size]
-                index = np.arange(chunk_movie.shape[0])
-                splits_index = np.array_split(index, nb_splits)
-                list_chunk_movie = [] #split of a chunk
-                for idx in splits_index:
-                    list_chunk_movie.append(chunk_movie[idx]) #each split of a chunk will be process in a different processor of the computer
-
-                new_chunk = map_function(procs, nb_splits, list_chunk_movie, template, dims, parameters)
-                new_chunk_arr = np.vstack(new_chunk)
-                hdf_mov['movie'][start_chunk:start_chunk+chunk_size] = np.array(new_chunk_arr) #update of the chunk
-                # if np.isinf(new_chunk_arr).sum(): Pdb().set_trace()
-
-            template = get_template(hdf_mov['movie'], dims, start = start_block, duration = new_block) #update the template after each block 
-    
-    hdf_mov['movie'].attrs['dims'] = dims
-    hdf_mov['movie'].attrs['duration'] = duration 
 
+    # rigid or piecewise correction, the mode chosen before the interruption is kept
+    if checkpoint is not None and 'mc_mode' in hdf_mov['movie'].attrs.keys():
+        mode    = str(hdf_mov['movie'].attrs['mc_mode'])
+    else:
+        mode    = get_correction_mode(get_source(hdf_mov), template, dims, parameters)
+    parameters  = dict(parameters, mode = mode)
+    hdf_mov['movie'].attrs['mc_mode'] = mode
+
+    # template updated after each chunk or after each block
+    running     = parameters.get('template_update', 'block') == 'running'
+
+    # shifts estimated in every round and applied after the last one
+    deferred    = parameters.get('deferred', False) and parameters['nb_round'] > 0
+
+    # shifts, correlation and shear of each frame
+    if parameters['nb_round'] > 0:
+        motion  = get_motion_datasets(hdf_mov, duration, dims, parameters, reset = checkpoint is None)
+        pdims   = get_patch_geometry(dims, parameters).pdims
+
+    # frames to correct again in the next round
+    adaptive    = parameters.get('adaptive', False) and not deferred
+    active      = np.ones(duration, dtype = bool)
+    if adaptive and checkpoint is not None and parameters['nb_round'] > 0: # frames of the rounds before the interruption
+        active  = motion['active'][:].astype(bool)
+
+    # the next chunks are read and the previous ones are written while a chunk is corrected
+    threaded    = parameters.get('pipeline', True)
+    nb_buffers  = 3 if threaded else 1
+
+    # frames and template in shared memory for a multiprocessing pool
+    shared = None
+    if parameters.get('shared_memory', True) and procs is not None and 'multiprocessing' in str(type(procs)):
+        shared = SharedFrames(chunk_size, dims, nb_buffers)
+        buffers = shared.frames
+    else:
+        buffers = np.zeros((nb_buffers, chunk_size, np.prod(dims)), dtype = np.float32)
+
+    def read_chunk(start_chunk, buffer):
+        return read_frames(get_source(hdf_mov), start_chunk, start_chunk+chunk_size, buffers[buffer])
+
+    progress = {} # template computed by the writer at the end of a block
+
+    def write_chunk(start_chunk, result):
+        """ Write the corrected frames of a chunk and save the checkpoint just after them, so that a resumed correction
+        does not correct the written frames a second time. At the end of the block that starts at start_block, the template
+        of the next block is computed from the written frames of the block and saved with the checkpoint """
+        new_chunk_arr, nb_frames, nb_round, template, start_block, chunk_motion = result
+        if len(new_chunk_arr) > 0: # some frames of the chunk were corrected
+            hdf_mov['movie'][start_chunk:start_chunk+len(new_chunk_arr)] = cast_frames(new_chunk_arr, hdf_mov['movie'].dtype) #update of the chunk
+        write_motion(start_chunk, nb_frames, chunk_motion)
+        if start_block is not None and start_chunk+nb_frames == min(start_block+new_block, duration):
+            template = get_template(hdf_mov['movie'], dims, start = start_block, duration = new_block) #update the template after each block
+            progress['template'] = template
+        save_checkpoint(hdf_mov, nb_round, start_chunk+nb_frames, template, correction_key)
+
+    def write_motion(start_chunk, nb_frames, chunk_motion):
+        """ Write the shifts, correlation, shear and selection of the frames of a chunk in the group motion """
+        for name, values in chunk_motion.items():
+            motion[name][start_chunk:start_chunk+nb_frames] = values
+
+    def set_template(template):
+        """ Give the template to the workers. Without shared memory, the template is filtered once for all the splits """
+        if shared is not None:
+            shared.set_template(template)
+            return None
+        return PreparedTemplate(template, dims, parameters)
+
+    def correct_chunk(buffer, chunk_movie, task, shifts):
+        """ Return the corrected frames of the chunk read in the buffer and their (shifts_rigid, shifts_patch) (see correct_shared_frames for the task) """
+        nb_splits = scheduler.get_nb_splits(len(chunk_movie))
+        begin = time.time()
+        new_chunk_arr, results = split_chunk(buffer, chunk_movie, nb_splits, task, shifts)
+        scheduler.update(len(chunk_movie), nb_splits, time.time() - begin)
+        return new_chunk_arr, (np.vstack([r[0] for r in results]), np.concatenate([r[1] for r in results]))
+
+    def split_chunk(buffer, chunk_movie, nb_splits, task, shifts):
+        """ Correct the splits of the chunk on the workers """
+        if shared is not None:
+            return map_shared(procs, shared, buffer, len(chunk_movie), nb_splits, parameters, task, shifts)
+        index = np.arange(chunk_movie.shape[0])
+        splits_index = np.array_split(index, nb_splits)
+        list_chunk_movie = [] #split of a chunk
+        for idx in splits_index:
+            list_chunk_movie.append(chunk_movie[idx]) #each split of a chunk will be process in a different processor of the computer
+
+        if task == 'apply':
+            new_chunk = map_function(procs, nb_splits, list_chunk_movie, [(shifts[0][idx], shifts[1][idx]) for idx in splits_index], dims, parameters, apply_shifts)
+            return np.vstack(new_chunk), [shifts]
+        results = map_function(procs, nb_splits, list_chunk_movie, prepared_template, dims, parameters, estimate_shifts if task == 'estimate' else make_corrections)
+        return np.vstack([r[0] for r in results]), [r[1:] for r in results]
+
+    pipeline = ChunkPipeline(read_chunk, write_chunk, nb_buffers, threaded)
+    estimate_pipeline = ChunkPipeline(read_chunk, lambda start_chunk, result: write_motion(start_chunk, result[1], result[5]), nb_buffers, threaded) # only the shifts are written while they are estimated
+    try:
+        for i in range(start_round, parameters['nb_round'] + int(deferred)): # loop on the movie
+            task = 'correct' if not deferred else 'estimate' if i < parameters['nb_round'] else 'apply'
+            round_pipeline = estimate_pipeline if task == 'estimate' else pipeline
+            blocks = block_starts[block_starts + new_block > start_frame] # the correction can be resumed in the middle of a block
+            round_pipeline.start([s for b in blocks for s in np.arange(max(b, start_frame), min(b+new_block, duration), chunk_size)])
+            nb_corrected = 0
+            for start_block in tqdm(blocks): # for each block
+                end_block = min(start_block+new_block, duration)
+                chunk_starts_loc = np.arange(max(start_block, start_frame),end_block,chunk_size)
+                if task != 'apply':
+                    prepared_template = set_template(template) # the template is filtered once for the whole block
+                block_frames = [] # frames of the block with their rigid correction for the template
+                for start_chunk in chunk_starts_loc: # for each chunk                
+                    start_chunk, buffer, chunk_movie = round_pipeline.get()
+                    frames = slice(start_chunk, start_chunk+len(chunk_movie))
+                    shifts = None
+                    if task == 'apply':
+                        shifts = (motion['shifts_rigid'][frames], motion['shifts_patch'][frames])
+                    select = np.ones(len(chunk_movie), dtype = bool)
+                    if adaptive and i > 0:
+                        select = active[frames]
+                    if select.all():
+                        new_chunk_arr, shifts_chunk = correct_chunk(buffer, chunk_movie, task, shifts)
+                    else: # the selected frames are moved to the beginning of the buffer and corrected. The others are not shifted and keep their saved shifts
+                        new_chunk_arr = np.array(chunk_movie)
+                        shifts_chunk = (np.zeros((len(chunk_movie), 2)), np.zeros((len(chunk_movie),)+motion['shifts_patch'].shape[1:]))
+                        if select.any():
+                            buffers[buffer][0:select.sum()] = new_chunk_arr[select]
+                            new_frames, new_shifts = correct_chunk(buffer, buffers[buffer][0:select.sum()], task, shifts)
+                            new_chunk_arr[select] = new_frames
+                            shifts_chunk[0][select], shifts_chunk[1][select] = new_shifts
+                    chunk_motion = {} # written with the chunk (see write_chunk)
+                    if task != 'apply':
+                        shifts_total = shifts_chunk
+                        if task == 'correct' and i > 0: # the frames were corrected in the previous rounds
+                            shifts_total = (motion['shifts_rigid_previous'][frames] + shifts_chunk[0], motion['shifts_patch_previous'][frames] + shifts_chunk[1])
+                        chunk_motion['shifts_rigid'], chunk_motion['shifts_patch'] = shifts_total
+                        chunk_motion['shear'] = get_shear(shifts_total[1], pdims)
+                    if adaptive:
+                        active[frames] = np.maximum(np.abs(shifts_chunk[0]).max(1), np.abs(shifts_chunk[1]).max((1, 2))) > parameters.get('recorrect_shift', 0.25)
+                        chunk_motion['active'] = active[frames].copy()
+                    if task != 'estimate':
+                        chunk_motion['corr'] = get_correlation(new_chunk_arr, template)
+                    if task == 'estimate' and not running:
+                        block_frames.append(np.array(new_chunk_arr))
+                    if running and task != 'apply':
+                        template = update_template(template, new_chunk_arr, dims, parameters.get('template_rate', 0.5))
+                        prepared_template = set_template(template)
+                    round_pipeline.put(start_chunk, buffer, (new_chunk_arr if select.any() else new_chunk_arr[0:0], len(chunk_movie), i, template, start_block if task == 'correct' and not running else None, chunk_motion))
+                    nb_corrected += select.sum()
+
+                round_pipeline.flush() # the template is computed from the corrected frames of the block
+                if task == 'estimate':
+                    if not running:
+                        template = get_template(np.vstack(block_frames), dims, start = 0, duration = new_block)
+                    save_checkpoint(hdf_mov, i, end_block, template, correction_key) # nothing is written by the pipeline
+                elif task == 'correct' and not running:
+                    template = progress['template'] # computed and saved with the checkpoint by write_chunk
+
+            round_pipeline.stop()
+            if adaptive:
+                print("Round %i : %i frames corrected" % (i, nb_corrected))
+            start_frame = 0
+            if 'source' in hdf_mov['movie'].attrs.keys() and task != 'estimate': # every frame of the movie has been written
+                del hdf_mov['movie'].attrs['source']
+            if task == 'correct' and i+1 < parameters['nb_round']: # the shifts of the next round are added to the sums of the rounds up to this one
+                for name in ['shifts_rigid', 'shifts_patch']:
+                    for start_chunk in chunk_starts_glob:
+                        motion[name+'_previous'][start_chunk:start_chunk+chunk_size] = motion[name][start_chunk:start_chunk+chunk_size]
+            save_checkpoint(hdf_mov, i+1, start_frame, template, correction_key)
+    finally: # the threads and the shared memory are released even if the correction fails, without hiding its error
+        try:
+            pipeline.close()
+            estimate_pipeline.close()
+        finally:
+            if shared is not None:
+                del buffers
+                shared.close()
+
+    if estimate_pipeline.elapsed > 0:
+        print("Utilization of the stages of the estimation of the shifts : " + ", ".join("%s %.0f%%" % (stage, 100*u) for stage, u in estimate_pipeline.utilization().items()))
+    if pipeline.elapsed > 0:
+        print("Utilization of the stages of the motion correction : " + ", ".join("%s %.0f%%" % (stage, 100*u) for stage, u in pipeline.utilization().items()))
+
+    if 'source' in hdf_mov['movie'].attrs.keys(): # no round of motion correction
+        copy_frames(get_source(hdf_mov), hdf_mov['movie'])
+        del hdf_mov['movie'].attrs['source']
+
+    hdf_mov['movie'].attrs['mc_key'] = correction_key # the motion correction is finished
+    clear_checkpoint(hdf_mov)
+    update_tiled_copy(hdf_mov, parameters)
+    hdf_mov.flush()
     return hdf_mov, video_info
\ No newline at end of file
@@ -6,18 +6,28 @@ class Movie(object):
 		To play the movie
 		To not use for big movie as it may cause memory error
 		the best is to load in memory a chunk of the movie and instantiate a movie object
+		The data can also be flat (T, H*W), as the movie of the hdf5 file or a VideoStore, with the dimension dims = (H,W) of the frames.
+		Frames of a VideoStore are decoded when they are played.
 	"""
 
-	def __init__(self, data):
-		self.T, self.H, self.W = data.shape
+	def __init__(self, data, dims = None):
+		if dims is None and hasattr(data, 'dims'):
+			dims = tuple(data.dims)
+		if dims is None:
+			self.T, self.H, self.W = data.shape
+		else:
+			self.T, (self.H, self.W) = len(data), dims
 		self.data = data
 
 	def play(self, gain = 1, magnification = 1, looping = True, fr = 30):
-		maxmov = np.nanmax(self.data)
+		if isinstance(self.data, np.ndarray):
+			maxmov = np.nanmax(self.data)
+		else: # only the first frames are read to not decode the whole movie
+			maxmov = np.nanmax(np.asarray(self.data[0:min(self.T, 500)], dtype = np.float32))
 		end = False		
 		while looping:
 			for i in range(self.T):
-				frame = self.data[i]
+				frame = np.asarray(self.data[i], dtype = np.float32).reshape(self.H, self.W)
 				if magnification != 1:
 					frame = cv2.resize(frame, None, fx = magnification, fy = magnification, interpolation = cv2.INTER_LINEAR)
 				cv2.imshow('frame', frame * gain / maxmov)
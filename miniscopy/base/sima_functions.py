@@ -8,6 +8,7 @@ from builtins import str
 from builtins import range
 from past.utils import old_div
 import numpy as np
+import scipy.fft
 import cv2
 from cv2 import dft as fftn
 from cv2 import idft as ifftn
@@ -20,7 +21,7 @@ from numpy.fft import ifftshift
 #########################################
 
 
-def register_translation(src_image, target_image, upsample_factor=1, space="real", shifts_lb=None, shifts_ub=None, max_shifts=[3, 3], **kwargs):
+def register_translation(src_image, target_image, upsample_factor=1, space="real", shifts_lb=None, shifts_ub=None, max_shifts=[3, 3], dtype=np.float64, **kwargs):
     """
 
     adapted from SIMA (https://github.com/losonczylab) and the
@@ -85,6 +86,9 @@ def register_translation(src_image, target_image, upsample_factor=1, space="real
         will be FFT'd to compute the correlation, while "fourier" data will
         bypass FFT of input data.  Case insensitive.
 
+    dtype : np.float32 or np.float64, optional
+        Precision of the computation. With np.float32 the spectra are complex64.
+
     Returns:
     -------
     shifts : ndarray
@@ -137,6 +141,8 @@ max_shifts=parameters['max_shifts']
         raise NotImplementedError("Error: register_translation only supports "
                                   "subpixel registration for 2D images")
 
+    complex_dtype = np.result_type(dtype, np.complex64)
+
     # assume complex data is already in Fourier space
     if space.lower() == 'fourier':
         src_freq = src_image
@@ -144,15 +150,15 @@ max_shifts=parameters['max_shifts']
     # real data needs to be fft'd.
     elif space.lower() == 'real':
         if opencv:
-            src_freq_1 = fftn(src_image, flags=cv2.DFT_COMPLEX_OUTPUT + cv2.DFT_SCALE)
+            src_freq_1 = fftn(np.asarray(src_image, dtype=dtype), flags=cv2.DFT_COMPLEX_OUTPUT + cv2.DFT_SCALE)
             src_freq = src_freq_1[:, :, 0] + 1j * src_freq_1[:, :, 1]
-            src_freq = np.array(src_freq, dtype=np.complex128, copy=False)
-            target_freq_1 = fftn(target_image, flags=cv2.DFT_COMPLEX_OUTPUT + cv2.DFT_SCALE)
+            src_freq = np.array(src_freq, dtype=complex_dtype, copy=False)
+            target_freq_1 = fftn(np.asarray(target_image, dtype=dtype), flags=cv2.DFT_COMPLEX_OUTPUT + cv2.DFT_SCALE)
             target_freq = target_freq_1[:, :, 0] + 1j * target_freq_1[:, :, 1]
-            target_freq = np.array(target_freq, dtype=np.complex128, copy=False)
+            target_freq = np.array(target_freq, dtype=complex_dtype, copy=False)
         else:
-            src_image_cpx = np.array(src_image, dtype=np.complex128, copy=False)
-            target_image_cpx = np.array(target_image, dtype=np.complex128, copy=False)
+            src_image_cpx = np.array(src_image, dtype=complex_dtype, copy=False)
+            target_image_cpx = np.array(target_image, dtype=complex_dtype, copy=False)
             src_freq = np.fft.fftn(src_image_cpx)
             target_freq = fftn(target_image_cpx)
 
@@ -234,6 +240,184 @@ max_shifts=parameters['max_shifts']
 
     return shifts, src_freq, _compute_phasediff(CCmax)
 
+def register_translation_batch(src_images, target_images, upsample_factor=1, max_shifts=[3, 3], src_freq=None, dtype=np.float64):
+    """
+    Registration of a stack of images with the same algorithm as register_translation (see above), for the
+    upsampled cross-correlation and the limits max_shifts. The stack is transformed with one real FFT over
+    its last two axes and the peaks and their upsampled refinement are computed for every image at once.
+    Used to register every patch of the same shape of one frame or of several frames.
+
+    Parameters:
+    ----------
+    src_images : ndarray (..., h, w)
+        Reference images. The leading dimensions are broadcast against the ones of target_images
+        so that one template patch can be registered with the same patch of every frame.
+
+    target_images : ndarray (..., h, w)
+        Images to register.
+
+    upsample_factor : int, optional
+        Images will be registered to within ``1 / upsample_factor`` of a pixel.
+
+    max_shifts : the maximum shift in each dimension
+
+    src_freq : ndarray (..., h, w//2+1), optional
+        rfft2 of src_images divided by h*w, when it is computed once for a template
+        (see PreparedTemplate). src_images is not used then.
+
+    dtype : np.float32 or np.float64, optional
+        Precision of the computation. With np.float32 the FFTs (scipy.fft) and the upsampled DFT
+        are done on complex64 spectra, which halves the memory traffic.
+
+    Returns:
+    -------
+    shifts : ndarray (..., 2)
+        Shift vector (in pixels) required to register each target image with its source image.
+
+    phasediff : ndarray (...)
+        Global phase difference between each pair of images.
+    """
+    complex_dtype = np.result_type(dtype, np.complex64)
+    target_images = np.asarray(target_images, dtype=dtype)
+    shape = target_images.shape[-2:]
+    if src_freq is None:
+        src_images = np.asarray(src_images, dtype=dtype)
+        if src_images.shape[-2:] != shape:
+            raise ValueError("Error: images must really be same size for "
+                             "register_translation_batch")
+        src_freq = scipy.fft.rfft2(src_images) / np.prod(shape)
+    elif src_freq.shape[-2:] != (shape[0], shape[1]//2+1):
+        raise ValueError("Error: the spectrum of the source images does not match the images for "
+                         "register_translation_batch")
+    src_freq = np.asarray(src_freq, dtype=complex_dtype)
+    target_freq = (scipy.fft.rfft2(target_images) / np.prod(shape)).astype(complex_dtype, copy=False)
+    image_product = src_freq * target_freq.conj()
+    batch_shape = image_product.shape[:-2]
+    image_product = image_product.reshape((-1,) + image_product.shape[-2:])
+    nb_images = len(image_product)
+
+    # Whole-pixel shift - the cross-correlation of real images is real
+    cross_correlation = scipy.fft.irfft2(image_product, s=shape)
+    new_cross_corr = np.abs(cross_correlation)
+    new_cross_corr[:, max_shifts[0]:-max_shifts[0], :] = 0
+    new_cross_corr[:, :, max_shifts[1]:-max_shifts[1]] = 0
+
+    maxima = np.unravel_index(np.argmax(new_cross_corr.reshape(nb_images, -1), axis=1), shape)
+    midpoints = np.array([np.fix(old_div(axis_size, 2)) for axis_size in shape])
+    shifts = np.stack(maxima, axis=1).astype(np.float64)
+    shifts = np.where(shifts > midpoints, shifts - np.array(shape), shifts)
+
+    if upsample_factor == 1:
+        CCmax = cross_correlation.reshape(nb_images, -1).max(axis=1)
+    # If upsampling > 1, then refine estimate with matrix multiply DFT
+    else:
+        shifts = old_div(np.round(shifts * upsample_factor), upsample_factor)
+        upsampled_region_size = np.ceil(upsample_factor * 1.5)
+        dftshift = np.fix(old_div(upsampled_region_size, 2.0))
+        upsample_factor = np.array(upsample_factor, dtype=np.float64)
+        normalization = (np.prod(shape) * upsample_factor ** 2)
+        sample_region_offset = dftshift - shifts * upsample_factor
+        full_product = _full_spectrum(image_product, shape[1])
+        cross_correlation = _upsampled_dft_batch(full_product.conj(), int(upsampled_region_size), upsample_factor, sample_region_offset).conj()
+        cross_correlation /= normalization
+        maxima = np.unravel_index(np.argmax(np.abs(cross_correlation).reshape(nb_images, -1), axis=1), cross_correlation.shape[1:])
+        maxima = np.stack(maxima, axis=1).astype(np.float64) - dftshift
+        shifts = shifts + old_div(maxima, upsample_factor)
+        CCmax = cross_correlation.reshape(nb_images, -1).max(axis=1)
+
+    # If its only one row or column the shift along that dimension has no effect.
+    shifts[:, np.array(shape) == 1] = 0
+
+    return shifts.reshape(batch_shape + (2,)), _compute_phasediff(CCmax).reshape(batch_shape)
+
+def _full_spectrum(half_spectrum, width):
+    """
+    Rebuild the full 2D DFT of real images from the output of rfft2 with the hermitian symmetry
+    F[k0, k1] = conj(F[-k0, -k1]).
+    """
+    height = half_spectrum.shape[-2]
+    full = np.zeros(half_spectrum.shape[:-1] + (width,), dtype=half_spectrum.dtype)
+    full[..., :half_spectrum.shape[-1]] = half_spectrum
+    cols = np.arange(half_spectrum.shape[-1], width)
+    rows = (-np.arange(height)) % height
+    full[..., cols] = half_spectrum[..., rows, :][..., width - cols].conj()
+    return full
+
+_upsampling_kernels = {} # kernels of the upsampled DFT for each shape, region size, upsample factor and precision
+
+def _get_upsampling_kernels(shape, upsampled_region_size, upsample_factor, dtype):
+    """
+    Kernels of the upsampled DFT of 2D arrays (see _upsampled_dft) without the offsets of the region, computed once
+    for each shape, region size, upsample factor and precision. The kernel of an axis
+    exp(-1j * 2 * pi / (size * upsample_factor) * freq * (region - offset)) is the product of the cached kernel
+    exp(-1j * 2 * pi / (size * upsample_factor) * freq * region) and of a phase of the frequencies, that is applied
+    to the data instead (see _offset_phase).
+
+    Parameters:
+    ----------
+    shape : (height, width) of the data
+
+    upsampled_region_size : (rows, columns) of the region
+
+    upsample_factor : the upsampling factor
+
+    dtype : complex64 or complex128
+
+    Returns:
+    -------
+    row_kernel : ndarray (rows, height)
+
+    col_kernel : ndarray (width, columns)
+
+    row_freq, col_freq : the frequencies of the rows and of the columns
+    """
+    key = (tuple(int(s) for s in shape), tuple(int(s) for s in upsampled_region_size), float(upsample_factor), np.dtype(dtype))
+    if key not in _upsampling_kernels:
+        height, width = key[0]
+        col_freq = ifftshift(np.arange(width)) - np.floor(old_div(width, 2))
+        row_freq = ifftshift(np.arange(height)) - np.floor(old_div(height, 2))
+        col_kernel = np.exp((-1j * 2 * np.pi / (width * upsample_factor)) * col_freq[:, None] * np.arange(key[1][1])[None, :])
+        row_kernel = np.exp((-1j * 2 * np.pi / (height * upsample_factor)) * np.arange(key[1][0])[:, None] * row_freq[None, :])
+        _upsampling_kernels[key] = (row_kernel.astype(dtype), col_kernel.astype(dtype), row_freq, col_freq)
+    return _upsampling_kernels[key]
+
+def _offset_phase(freq, size, upsample_factor, offsets, dtype):
+    """
+    Phase exp(1j * 2 * pi / (size * upsample_factor) * freq * offset) of the frequencies of an axis for the offsets of the region.
+    Returns an array (..., len(freq)) for offsets of shape (...).
+    """
+    return np.exp((1j * 2 * np.pi / (size * upsample_factor)) * np.asarray(offsets, dtype=np.float64)[..., None] * freq).astype(dtype)
+
+def _upsampled_dft_batch(data, upsampled_region_size, upsample_factor, axis_offsets):
+    """
+    Upsampled DFT by matrix multiplication of a stack of 2D arrays (see _upsampled_dft).
+    The kernels are cached (see _get_upsampling_kernels) and the offsets of each image are applied to its data.
+
+    Parameters:
+    ----------
+    data : ndarray (n, h, w)
+        The DFT of each image.
+
+    upsampled_region_size : int
+        The size of the region to be sampled in both dimensions.
+
+    upsample_factor : integer
+        The upsampling factor.
+
+    axis_offsets : ndarray (n, 2)
+        The offsets of the region to be sampled for each image.
+
+    Returns:
+    -------
+    output : ndarray (n, upsampled_region_size, upsampled_region_size)
+    """
+    height, width = data.shape[-2:]
+    dtype = np.result_type(data.dtype, np.complex64)
+    row_kernel, col_kernel, row_freq, col_freq = _get_upsampling_kernels((height, width), (upsampled_region_size, upsampled_region_size), upsample_factor, dtype)
+    data = data * _offset_phase(row_freq, height, upsample_factor, axis_offsets[:, 0], dtype)[:, :, None]
+    data *= _offset_phase(col_freq, width, upsample_factor, axis_offsets[:, 1], dtype)[:, None, :]
+    return np.matmul(np.matmul(row_kernel, data), col_kernel)
+
 def _upsampled_dft(data, upsampled_region_size, upsample_factor=1, axis_offsets=None):
     """
     adapted from SIMA (https://github.com/losonczylab) and the scikit-image (http://scikit-image.org/) package.
@@ -322,6 +506,14 @@ def _upsampled_dft(data, upsampled_region_size, upsample_factor=1, axis_offsets=
             raise ValueError("number of axis offsets must be equal to input "
                              "data's number of dimensions.")
 
+    # 2D data : cached kernels in the precision of the data (see _get_upsampling_kernels)
+    if data.ndim == 2:
+        dtype = np.result_type(data.dtype, np.complex64)
+        row_kernel, col_kernel, row_freq, col_freq = _get_upsampling_kernels(data.shape, upsampled_region_size, upsample_factor, dtype)
+        data = data * _offset_phase(row_freq, data.shape[0], upsample_factor, axis_offsets[0], dtype)[:, None]
+        data *= _offset_phase(col_freq, data.shape[1], upsample_factor, axis_offsets[1], dtype)[None, :]
+        return row_kernel.dot(data).dot(col_kernel)
+
     col_kernel = np.exp(
         (-1j * 2 * np.pi / (data.shape[1] * upsample_factor)) *
         (ifftshift(np.arange(data.shape[1]))[:, None] -
@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+""" functions related to the storage of the movies in the hdf5 file
+
+
+"""
+import numpy as np
+import warnings
+import os
+import h5py as hd
+try:
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+
+class FloatDataset(object):
+    """
+        Read-only view of a dataset that converts the data to float32 when it is read.
+        Allows to store the movie in 8 bits in the hdf5 file while every computation is done in float.
+        Every other attribute (chunks, shape, attrs, ...) is the one of the dataset.
+    """
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __getitem__(self, key):
+        return np.asarray(self.dataset[key], dtype = np.float32)
+
+    def __getattr__(self, name):
+        return getattr(self.dataset, name)
+
+    def __len__(self):
+        return len(self.dataset)
+
+    @property
+    def dtype(self):
+        return np.dtype(np.float32)
+
+
+def cast_frames(frames, dtype):
+    """ Convert frames to the type of the dataset they are written to.
+    Frames are rounded and clipped to the range of integer types.
+
+    Parameters:
+    -frames : ndarray
+    -dtype : type of the dataset
+
+    Returns:
+    -frames : ndarray of type dtype"""
+
+    dtype = np.dtype(dtype)
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        return np.clip(np.round(frames), info.min, info.max).astype(dtype)
+    return np.asarray(frames, dtype = dtype)
+
+
+def get_storage_options(filter = None, level = None, shuffle = False, **kwargs):
+    """ Return the keyword arguments of h5py create_dataset for a compression filter.
+
+    Parameters:
+    -filter : None, 'lzf', 'gzip', 'blosc' or 'lz4'. blosc and lz4 require the package hdf5plugin.
+    -level : compression level for gzip (0-9) and blosc (0-9)
+    -shuffle : bool, apply the byte shuffle filter before compression
+
+    Returns:
+    -options : dict"""
+
+    if filter in [None, 'none', 'None']:
+        return {}
+    if filter in ['blosc', 'lz4'] and hdf5plugin is None:
+        warnings.warn("hdf5plugin is not installed, the lzf filter is used instead of " + filter)
+        filter = 'lzf'
+    if filter == 'lzf':
+        return {'compression':'lzf', 'shuffle':bool(shuffle)}
+    elif filter == 'gzip':
+        return {'compression':'gzip', 'compression_opts':4 if level is None else int(level), 'shuffle':bool(shuffle)}
+    elif filter == 'blosc':
+        blosc = hdf5plugin.Blosc(cname = 'lz4', clevel = 5 if level is None else int(level), shuffle = hdf5plugin.Blosc.SHUFFLE if shuffle else hdf5plugin.Blosc.NOSHUFFLE)
+        return dict(blosc)
+    elif filter == 'lz4':
+        options = dict(hdf5plugin.LZ4())
+        options['shuffle'] = bool(shuffle)
+        return options
+    else:
+        raise ValueError("Unknown compression filter : " + str(filter))
+
+
+def set_storage_options(file, filter = None, level = None, shuffle = False, **kwargs):
+    """ Save the compression filter as attributes of the hdf5 file.
+    Every dataset created after with create_dataset in this file uses this filter.
+
+    Parameters:
+    -file : the hdf5 file
+    -filter, level, shuffle : see get_storage_options"""
+
+    get_storage_options(filter, level, shuffle) # check the filter before saving it
+    file.attrs['storage_filter'] = str(filter)
+    file.attrs['storage_level'] = -1 if level is None else int(level)
+    file.attrs['storage_shuffle'] = bool(shuffle)
+
+
+def create_dataset(group, name, **kwargs):
+    """ Create a dataset in a group of the hdf5 file with the compression filter of the file (see set_storage_options).
+
+    Parameters:
+    -group : the hdf5 group or file
+    -name : str, name of the dataset
+    -kwargs : arguments of h5py create_dataset
+
+    Returns:
+    -dataset"""
+
+    attrs = group.file.attrs
+    if 'storage_filter' in attrs:
+        level = int(attrs['storage_level'])
+        kwargs.update(get_storage_options(attrs['storage_filter'], None if level < 0 else level, attrs['storage_shuffle']))
+    return group.create_dataset(name, **kwargs)
+
+
+def get_frame_chunks(dims, duration, dtype, chunk_frames = None, chunk_bytes = 2**20):
+    """ Chunk shape of a movie dataset of shape (duration, h*w).
+    Each chunk contains whole frames so that the motion correction reads and writes contiguous blocks.
+
+    Parameters:
+    -dims : dimension (h,w) of each frame
+    -duration : number of frames of the movie
+    -dtype : type of the dataset
+    -chunk_frames : number of frames in each chunk. If None, as many frames as fit in chunk_bytes (at least one)
+    -chunk_bytes : size of a chunk in bytes
+
+    Returns:
+    -chunks : tuple"""
+
+    d = int(np.prod(dims))
+    if chunk_frames is None:
+        chunk_frames = chunk_bytes // (d*np.dtype(dtype).itemsize)
+    return (int(np.clip(chunk_frames, 1, max(duration, 1))), d)
+
+
+def read_frames(dataset, start, end, out):
+    """ Read the frames start to end of a movie dataset in the first rows of the array out.
+    The hdf5 datasets are read directly in out (h5py read_direct) without intermediate array.
+
+    Parameters:
+    -dataset : the movie dataset (h5py or MemmapDataset)
+    -start, end : the frames to read
+    -out : ndarray with at least end-start rows
+
+    Returns:
+    -frames : the view of out with the frames"""
+
+    end = min(end, len(dataset))
+    if isinstance(dataset, hd.Dataset):
+        dataset.read_direct(out, np.s_[start:end], np.s_[0:end-start])
+    else:
+        out[0:end-start] = dataset[start:end]
+    return out[0:end-start]
+
+
+def write_tiled_copy(file, name = 'movie', tile_frames = 128):
+    """ Write a copy of a movie dataset with chunks of tile_frames frames by one row of the image.
+    The copy is contiguous in time for each group of pixels. It is read by the patches of CNMFE that load
+    all the frames of a few pixels at once, which touch every chunk of the frame-major movie.
+    The copy is called name+'_tiled' and is written in one pass over the movie.
+
+    Parameters:
+    -file : the hdf5 file
+    -name : str, the name of the movie dataset, with the attributes dims and duration
+    -tile_frames : number of frames in each chunk of the copy
+
+    Returns:
+    -dataset"""
+
+    movie       = file[name]
+    dims        = tuple(movie.attrs['dims'])
+    duration    = movie.shape[0]
+    tile_frames = int(np.clip(tile_frames, 1, max(duration, 1)))
+    if name+'_tiled' in file.keys():
+        del file[name+'_tiled']
+    tiled       = create_dataset(file, name+'_tiled', shape = movie.shape, dtype = movie.dtype, chunks = (tile_frames, dims[1]))
+    for i in range(0, duration, tile_frames):
+        tiled[i:i+tile_frames] = movie[i:i+tile_frames]
+    for key in movie.attrs.keys():
+        tiled.attrs[key] = movie.attrs[key]
+    return tiled
+
+
+class MemmapDataset(object):
+    """
+        Movie stored in a raw binary file (.npy) opened with np.memmap.
+        It has the same interface as the movie dataset of the hdf5 file (shape, dtype, chunks, attrs, slicing)
+        but slicing returns views of the file served by the page cache of the system.
+        The attributes are saved in the hdf5 file of the MemmapFile.
+    """
+
+    def __init__(self, file, name):
+        self.file   = file
+        self.name   = name
+        self.group  = file.hdf['memmap/'+name]
+        self.path   = os.path.join(file.folder, self.group.attrs['path'])
+        self.data   = np.load(self.path, mmap_mode = 'r+' if file.mode != 'r' else 'r')
+        self.chunks = tuple(self.group.attrs['chunks'])
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def attrs(self):
+        return self.group['attrs'].attrs
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    def flush(self):
+        self.data.flush()
+
+
+class MemmapFile(object):
+    """
+        hdf5 file in which the datasets created at the root (movie, original) are raw binary files opened with np.memmap.
+        The binary files are saved next to the hdf5 file. Groups and every other dataset are kept in the hdf5 file.
+    """
+
+    def __init__(self, filename, mode = 'r+'):
+        self.hdf        = hd.File(filename, mode)
+        self.mode       = mode
+        self.folder     = os.path.dirname(os.path.abspath(filename))
+        self.datasets   = {}
+        if 'memmap' not in self.hdf.keys():
+            self.hdf.create_group('memmap')
+
+    def create_dataset(self, name, shape, dtype = np.float32, chunks = None, **kwargs):
+        """ compression and the other arguments of h5py are ignored """
+        if name in self.keys():
+            raise ValueError("Unable to create dataset (name already exists)")
+        path    = os.path.splitext(os.path.basename(self.hdf.filename))[0] + '_' + name + '.npy'
+        group   = self.hdf['memmap'].create_group(name)
+        group.attrs['path'] = path
+        if chunks is None or chunks is True:
+            chunks = get_frame_chunks((shape[1],), shape[0], dtype)
+        group.attrs['chunks'] = chunks
+        group.create_group('attrs')
+        np.lib.format.open_memmap(os.path.join(self.folder, path), mode = 'w+', dtype = dtype, shape = tuple(int(s) for s in shape)).flush()
+        return self[name]
+
+    def keys(self):
+        return [k for k in self.hdf.keys() if k != 'memmap'] + list(self.hdf['memmap'].keys())
+
+    def __contains__(self, name):
+        return name in self.keys()
+
+    def __getitem__(self, name):
+        if name in self.hdf['memmap'].keys():
+            if name not in self.datasets:
+                self.datasets[name] = MemmapDataset(self, name)
+            return self.datasets[name]
+        return self.hdf[name]
+
+    def __delitem__(self, name):
+        if name in self.hdf['memmap'].keys():
+            path = os.path.join(self.folder, self.hdf['memmap/'+name].attrs['path'])
+            self.datasets.pop(name, None)
+            del self.hdf['memmap/'+name]
+            os.remove(path)
+        else:
+            del self.hdf[name]
+
+    def __getattr__(self, name):
+        return getattr(self.hdf, name)
+
+    @property
+    def file(self):
+        return self
+
+    def flush(self):
+        for dset in self.datasets.values():
+            dset.flush()
+        self.hdf.flush()
+
+    def close(self):
+        if self.mode != 'r':
+            self.flush()
+        self.datasets = {}
+        self.hdf.close()
+
+
+def open_file(filename, mode = 'r+'):
+    """ Open the hdf5 file of a movie, as a MemmapFile if its movies are stored in binary files """
+    with hd.File(filename, 'r') as file:
+        memmap = 'memmap' in file.keys()
+    return MemmapFile(filename, mode) if memmap else hd.File(filename, mode)
@@ -22,11 +22,13 @@ from .initialization import initialize_components, get_noise_fft, local_correlat
 from .deconvolution import constrained_foopsi
 from .temporal import update_temporal_components
 from .spatial import update_spatial_components
+from ..base.utilities import FloatDataset, create_dataset, set_storage_options, get_frame_chunks
 
 class Patch(object):
 
-	def __init__(self, group, duration, patch_number, patch_index, parameters):
+	def __init__(self, group, duration, patch_number, patch_index, parameters, movie):
 		self.patch_group    = group
+		self.movie          = movie # the movie of the CNMFE object, read in float
 		self.parameters     = parameters
 		self.duration       = duration
 		self.patch_number   = patch_number      
@@ -45,7 +47,7 @@ class Patch(object):
 		self.count_bgr      = None
 		self.count_nrs      = None
 		# # create the patch movie      
-		self.Y              = self.patch_group.create_dataset('Y', shape = (self.duration, np.prod(self.dims)), dtype = np.float32, chunks = (32,self.dims[1]))
+		self.Y              = create_dataset(self.patch_group, 'Y', shape = (self.duration, np.prod(self.dims)), dtype = np.float32, chunks = (32,self.dims[1]))
 		self.chunks         = self.Y.chunks     
 		return
 	
@@ -78,7 +80,7 @@ class CNMFE(object):
 		self.file           = file      # the hdf5 file of the original movie corrected for motion
 		self.filename       = self.file.attrs['filename']
 		self.parameters     = parameters
-		self.Y              = file['movie']
+		self.Y              = FloatDataset(file['movie_tiled'] if 'movie_tiled' in file.keys() else file['movie']) # the movie can be stored in 8 bits, it is read in float
 		self.duration       = file['movie'].attrs['duration']
 		self.dims           = tuple(file['movie'].attrs['dims'])                
 		self.patch_object   = {}
@@ -96,7 +98,13 @@ class CNMFE(object):
 		self.A_file         = None
 		self.YrA_file       = None      
 		self.bf             = None
+		if parameters.get('storage') is not None: # the compression filter of the file can be changed for the cnmfe datasets
+			set_storage_options(self.file, **parameters['storage'])
 		# every patch array will be stored in the group patches in the hdf5 self.file
+		# the results of a previous run on the same file are replaced
+		for name in ['patches', 'cnmfe']:
+			if name in self.file.keys():
+				del self.file[name]
 		self.patch_group    = self.file.create_group('patches')
 		self.cnmfe_group    = self.file.create_group('cnmfe')
 		return
@@ -121,7 +129,7 @@ class CNMFE(object):
 		# first the patch class and patch group
 		for i in tqdm(range(len(self.patch_index))):        
 			group = self.patch_group.create_group('patch_'+str(i)) # subgroup of the group patches
-			self.patch_object[i] = Patch(group, self.duration, i, self.patch_index[i], self.parameters)
+			self.patch_object[i] = Patch(group, self.duration, i, self.patch_index[i], self.parameters, self.Y)
 			
 			# the dataset of the patch movie is instantiated but not copied from the original movie
 			# it is done when the first function get_noise_fft is called with chunking
@@ -169,12 +177,12 @@ class CNMFE(object):
 				global_neuron_position[i] = np.vstack(global_neuron_position[i])                
 				self.count_nrs += len(keep)         
 						
-		self.A      = self.cnmfe_group.create_dataset('A', shape = (self.count_nrs, d), chunks = True) # The spatial footprint of size (d,K) with d = (h*w) # python style in lines
-		self.C      = self.cnmfe_group.create_dataset('C', shape = (self.duration, self.count_nrs), chunks = True)  # The calcium activities of K neurons of size (K,T) 
-		self.YrA    = self.cnmfe_group.create_dataset('YrA', shape = (self.duration, self.count_nrs), chunks = True)  # The calcium activities of K neurons of size (K,T) 
-		self.S      = self.cnmfe_group.create_dataset('S', shape = (self.duration, self.count_nrs), chunks = True) # The spiking activity
-		self.b      = self.cnmfe_group.create_dataset('b', shape = (self.count_bgr, d), chunks = True) # The background fluorescence
-		self.f      = self.cnmfe_group.create_dataset('f', shape = (self.duration, self.count_bgr), chunks = True) # the background noise in time       
+		self.A      = create_dataset(self.cnmfe_group, 'A', shape = (self.count_nrs, d), chunks = True) # The spatial footprint of size (d,K) with d = (h*w) # python style in lines
+		self.C      = create_dataset(self.cnmfe_group, 'C', shape = (self.duration, self.count_nrs), chunks = True)  # The calcium activities of K neurons of size (K,T) 
+		self.YrA    = create_dataset(self.cnmfe_group, 'YrA', shape = (self.duration, self.count_nrs), chunks = True)  # The calcium activities of K neurons of size (K,T) 
+		self.S      = create_dataset(self.cnmfe_group, 'S', shape = (self.duration, self.count_nrs), chunks = True) # The spiking activity
+		self.b      = create_dataset(self.cnmfe_group, 'b', shape = (self.count_bgr, d), chunks = True) # The background fluorescence
+		self.f      = create_dataset(self.cnmfe_group, 'f', shape = (self.duration, self.count_bgr), chunks = True) # the background noise in time       
 		
 		self.center = np.zeros((self.count_nrs,2))
 		start = 0
@@ -452,12 +460,15 @@ class CNMFE(object):
 	def get_correlation_info(self, filter_ = False):
 		import cv2
 		dims 	= self.dims
-		chunk_size  = self.Y.chunks[0]       
+		# the chunks do not depend on the dataset read (movie or movie_tiled) : chunks of about 1 MB of the filtered movie
+		# and about 32 MB of frames read and filtered at once
+		chunk_frames = get_frame_chunks(dims, self.duration, np.float32)[0]
+		chunk_size  = get_frame_chunks(dims, self.duration, np.float32, chunk_bytes = 2**25)[0] // chunk_frames * chunk_frames
 
 		if 'filtered_movie' in self.cnmfe_group.keys():
 			data_filtered = self.cnmfe_group['filtered_movie']
 		else:
-			data_filtered  = self.cnmfe_group.create_dataset('filtered_movie', shape = (self.duration, dims[0], dims[1]), chunks = (chunk_size,dims[0],dims[1]))
+			data_filtered  = create_dataset(self.cnmfe_group, 'filtered_movie', shape = (self.duration, dims[0], dims[1]), chunks = (chunk_frames,dims[0],dims[1]))
 				
 		if filter_:
 			gSig = self.parameters['init_params']['gSig']
@@ -29,6 +29,7 @@ from .spatial import circular_constraint
 from .deconvolution import deconvolve_ca
 from .temporal import update_temporal_components
 from .spatial import update_spatial_components
+from ..base.utilities import create_dataset
 
 def get_noise_fft(Y, max_num_samples_fft=3072, noise_range=[0.25,0.5], noise_method='logmexp', **kwargs):
     """Estimate the noise level for each pixel by averaging the power spectral density.
@@ -258,8 +259,8 @@ def local_correlations_fft(data, **kwargs):
         return np.mean(dataconv*data, axis = 0) / MASK
 
     elif isinstance(data, h5py._hl.dataset.Dataset):
-        new_data = data.parent.create_dataset('tmp', shape = data.shape, chunks = True)
-        dataconv = data.parent.create_dataset('dataconv', shape = data.shape, chunks = True)
+        new_data = create_dataset(data.parent, 'tmp', shape = data.shape, chunks = True)
+        dataconv = create_dataset(data.parent, 'dataconv', shape = data.shape, chunks = True)
         data_mean = np.mean(data, 0)
         data_std = np.std(data, 0)
         data_std[data_std == 0] = np.inf
@@ -273,7 +274,7 @@ def local_correlations_fft(data, **kwargs):
             new_data[i:i+chunk_size,:] = tmp
             for j, frame in enumerate(tmp):
                 dataconv[i+j] = cv2.filter2D(frame, -1, sz, borderType =0)
-        corr += np.sum(new_data[i:i+chunk_size,:,:] * dataconv[i:i+chunk_size,:,:], axis = 0)
+            corr += np.sum(new_data[i:i+chunk_size,:,:] * dataconv[i:i+chunk_size,:,:], axis = 0)
 
         corr /= float(data.shape[0])
 
@@ -588,7 +589,7 @@ def greedyROI_corr(patch, Yc, tsub, ssub, ring_size_factor, **kwargs):
         # original size in time first
         nr = C.shape[1]
         if nr:
-            patch.C = patch.patch_group.create_dataset('C', shape = (patch.duration,nr), chunks = (patch.chunks[0],1))
+            patch.C = create_dataset(patch.patch_group, 'C', shape = (patch.duration,nr), chunks = (patch.chunks[0],1))
             if tsub > 1:
                 index = np.arange(duration).repeat(tsub)
                 if len(index) <= patch.duration:
@@ -599,7 +600,7 @@ def greedyROI_corr(patch, Yc, tsub, ssub, ring_size_factor, **kwargs):
             elif tsub == 1:
                 patch.C[:] = C[:]
         else:
-            patch.C = patch.patch_group.create_dataset('C', shape = (patch.duration, nr))
+            patch.C = create_dataset(patch.patch_group, 'C', shape = (patch.duration, nr))
 
         tmp = patch.C.value.dot(A)
 
@@ -620,7 +621,7 @@ def greedyROI_corr(patch, Yc, tsub, ssub, ring_size_factor, **kwargs):
 
         # original size in space
         if ssub > 1:                                    
-            patch.B = patch.patch_group.create_dataset('B', shape = (patch.duration, np.prod(patch.dims)), chunks = patch.chunks)
+            patch.B = create_dataset(patch.patch_group, 'B', shape = (patch.duration, np.prod(patch.dims)), chunks = patch.chunks)
             chunk_size = patch.B.chunks[0]
             # resize YplusB in original size
             for i in range(0, patch.duration+chunk_size,chunk_size):
@@ -631,9 +632,9 @@ def greedyROI_corr(patch, Yc, tsub, ssub, ring_size_factor, **kwargs):
                     stop = j+1                                
                 patch.B[i:i+stop] = data[0:stop,:]
             if nr:
-                patch.A = patch.patch_group.create_dataset('A', shape = (nr, np.prod(patch.dims)), chunks = (1,patch.chunks[1]))            
+                patch.A = create_dataset(patch.patch_group, 'A', shape = (nr, np.prod(patch.dims)), chunks = (1,patch.chunks[1]))            
             else:
-                patch.A = patch.patch_group.create_dataset('A', shape = (nr, np.prod(patch.dims)))            
+                patch.A = create_dataset(patch.patch_group, 'A', shape = (nr, np.prod(patch.dims)))            
             # resize A in original size                
             for n, frame in enumerate(A):
                 patch.A[n] = cv2.resize(frame.reshape(new_dims), patch.dims[::-1], interpolation = cv2.INTER_NEAREST).flatten()[:]
@@ -706,12 +707,12 @@ def greedyROI_corr(patch, Yc, tsub, ssub, ring_size_factor, **kwargs):
     f_in = np.linalg.lstsq(b_in, B.T, rcond = None)[0]
     
     # need to resize 
-    patch.b = patch.patch_group.create_dataset('b', shape = (b_in.shape[1], np.prod(patch.dims)), chunks=(1,patch.chunks[0]))
+    patch.b = create_dataset(patch.patch_group, 'b', shape = (b_in.shape[1], np.prod(patch.dims)), chunks=(1,patch.chunks[0]))
     for i in range(patch.b.shape[0]):        
         tmp = b_in[:,i].astype(np.float32).reshape(new_dims)
         patch.b[i,:] = cv2.resize(tmp, patch.dims[::-1], interpolation=cv2.INTER_LINEAR).flatten()[:]    
 
-    patch.f = patch.patch_group.create_dataset('f', data = f_in.astype(np.float32).T, chunks=(patch.chunks[1],1))
+    patch.f = create_dataset(patch.patch_group, 'f', data = f_in.astype(np.float32).T, chunks=(patch.chunks[1],1))
 
     return
 
@@ -719,7 +720,7 @@ def downscale(patch, ssub, tsub):
     """downscaling without zero padding
     """        
     new_dims    = (patch.duration//tsub,patch.dims[0]//ssub, patch.dims[1]//ssub)    
-    Yc          = patch.patch_group.create_dataset('Yc', shape = (new_dims[0], np.prod(new_dims[1:])), chunks = True) # The spatial footprint of size (d,K) with d = (h*w) # python style in lines        
+    Yc          = create_dataset(patch.patch_group, 'Yc', shape = (new_dims[0], np.prod(new_dims[1:])), chunks = True) # The spatial footprint of size (d,K) with d = (h*w) # python style in lines        
     chunk_size  = patch.Y.chunks[0]
     tmp         = np.zeros((patch.duration, np.prod(new_dims[1:])))
     for i in range(0, patch.duration+chunk_size, chunk_size):        
@@ -63,8 +63,13 @@ def get_noise_fft(patch, max_num_samples_fft=3072, noise_range=[0.25,0.5], noise
 	psdx 		= np.zeros((patch.Y.shape[1],ind.sum()))
 	# Pdb().set_trace()
 	
+	movie 		= patch.movie
 	for i in range(0, patch.Y.shape[1], patch.chunks[1]): # doing it row by row
-		data = patch.patch_group.parent.parent['movie'][:,patch.xy[i:i+patch.chunks[1]]]
+		xy = patch.xy[i:i+patch.chunks[1]]
+		if xy[-1] - xy[0] + 1 == len(xy): # one row of the patch is a contiguous block of pixels
+			data = movie[:,xy[0]:xy[-1]+1]
+		else:
+			data = movie[:,xy]
 		patch.Y[:,i:i+patch.chunks[1]] = data
 		sample = data[idx_frames]
 		dft = np.fft.fft(sample, axis = 0)[:len(ind)][ind].T
@@ -3,6 +3,7 @@ from IPython.core.debugger import Pdb
 import cv2
 import scipy.sparse as spr
 import h5py as hd
+from ..base.utilities import create_dataset
 
 def generate_data(frate, N, T, dims, framerate=100):
     from scipy.ndimage.filters import gaussian_filter
@@ -144,9 +145,9 @@ def compute_residuals(patch):
         
     YrA = (YA - Cf.dot(AA.T))[:,:patch.A.shape[0]]
     if patch.A.shape[0]:
-        patch.YrA = patch.patch_group.create_dataset('YrA', data = YrA, chunks = (patch.chunks[0], 1))
+        patch.YrA = create_dataset(patch.patch_group, 'YrA', data = YrA, chunks = (patch.chunks[0], 1))
     else:
-        patch.YrA = patch.patch_group.create_dataset('YrA', data = YrA)
+        patch.YrA = create_dataset(patch.patch_group, 'YrA', data = YrA)
     
     # print("Time to compute_residuals ", time() - start)
     return
@@ -308,7 +309,7 @@ def copy_data(filename, source, target, name, index, chunking):
   print("yo")
   file = hd.File(filename, 'r+')
   print(file[source].shape)
-  file[target].create_dataset(name, data = file[source][:,index], chunks = chunking)
+  create_dataset(file[target], name, data = file[source][:,index], chunks = chunking)
   print(file[target+'/'+name].shape)
   file.close()
   del file
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+'''
+    Benchmark of the storage of the movie in the hdf5 file against a raw binary file opened with np.memmap
+    (see miniscopy.base.utilities.MemmapFile).
+    Three access patterns are timed on a synthetic movie generated with miniscopy.generate_data :
+    - chunks of whole frames, as in normcorre
+    - small blocks of frames x pixels, as in compute_residuals and update_temporal_components
+    - columns of pixels over all the frames, as in get_noise_fft and the spatial regression
+
+    python testbench/benchmark_backend.py [duration] [height] [width]
+'''
+import sys, os, tempfile, shutil
+from time import time
+import numpy as np
+import h5py as hd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from miniscopy import generate_data
+from miniscopy.base.utilities import MemmapFile, FloatDataset, create_dataset, get_frame_chunks
+
+
+def read_frames(movie, chunk_size = 64):
+    for i in range(0, movie.shape[0], chunk_size):
+        data = movie[i:i+chunk_size]
+        data.sum()
+
+def read_blocks(movie, rows = 32, cols = 1000):
+    for i in range(0, movie.shape[0], rows):
+        for j in range(0, movie.shape[1], cols):
+            data = movie[i:i+rows,j:j+cols]
+            data.sum()
+
+def read_columns(movie, cols = 50, step = 10):
+    for j in range(0, movie.shape[1], cols*step):
+        data = movie[:,j:j+cols]
+        data.sum()
+
+
+if __name__ == '__main__':
+    T = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    dims = (int(sys.argv[2]), int(sys.argv[3])) if len(sys.argv) > 3 else (240, 376)
+    N = 20
+    frate = np.random.poisson(0.05, (T, N)).astype(np.float32)
+    movie, true_data = generate_data(frate, N, T, dims)
+    movie = movie.astype(np.float32)
+
+    path = tempfile.mkdtemp()
+    files = {'hdf5':hd.File(os.path.join(path, 'hdf5.hdf5'), 'w'), 'memmap':MemmapFile(os.path.join(path, 'memmap.hdf5'), 'w')}
+    print("Movie of %i frames of %ix%i pixels" % (T, dims[0], dims[1]))
+    print("%-8s %12s %12s %12s %12s" % ('backend', 'write (s)', 'frames (s)', 'blocks (s)', 'columns (s)'))
+    for backend, file in files.items():
+        start = time()
+        dset = create_dataset(file, 'movie', shape = movie.shape, dtype = np.float32, chunks = get_frame_chunks(dims, T, np.float32))
+        for i in range(0, T, 64):
+            dset[i:i+64] = movie[i:i+64]
+        file.flush()
+        write_time = time() - start
+        times = []
+        for func in [read_frames, read_blocks, read_columns]:
+            start = time()
+            func(FloatDataset(dset))
+            times.append(time() - start)
+        print("%-8s %12.3f %12.3f %12.3f %12.3f" % (backend, write_time, times[0], times[1], times[2]))
+        file.close()
+    shutil.rmtree(path)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+'''
+    Benchmark of the blending of the corrected patches in tile_and_correct.
+    The loop over the upsampled patches used before PatchGeometry is copied below as a reference and
+    compared with PatchGeometry.blend for the time per frame and the difference of the blended images.
+
+    python testbench/benchmark_blending.py [height] [width] [nb_frames]
+'''
+import sys, os
+from time import time
+import numpy as np
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from miniscopy.base.motion_correction import PatchGeometry
+
+
+def blend_loop(image, new_upsamp_patches, upsamp_patches_index, upsamp_wdims, new_overlaps):
+    """ blending of tile_and_correct before PatchGeometry """
+    normalizer      = np.ones_like(image)
+    new_image       = np.copy(image)
+    tmp             = np.ones(upsamp_wdims)    
+    tmp[:new_overlaps[0], :] = np.linspace(0, 1, new_overlaps[0])[:, None]
+    corner          = np.flip(tmp, 0) * np.rot90(tmp, -1)
+    tmp             = tmp*np.flip(tmp, 0)
+    tmp2             = np.ones(upsamp_wdims)    
+    tmp2[:, :new_overlaps[1]] = np.linspace(0, 1, new_overlaps[1])[None, :]
+    tmp2            = tmp2*np.flip(tmp2, 1)
+    blending_func   = tmp*tmp2        
+    upper_band       = np.ones(upsamp_wdims)    
+    upper_band[-new_overlaps[0]:,:] = np.linspace(1, 0, new_overlaps[0])[:, None]
+    upper_band = np.rot90(upper_band, -1)*upper_band*np.rot90(upper_band, 1)
+    left_band = np.rot90(upper_band, 1)
+
+
+    for i, patch_pos in enumerate(upsamp_patches_index):            
+        xs, xe, ys, ye = (patch_pos[0],patch_pos[0]+upsamp_wdims[0],patch_pos[1],patch_pos[1]+upsamp_wdims[1])        
+        ye = np.minimum(ye, new_image.shape[1])
+        xe = np.minimum(xe, new_image.shape[0])
+        prev_norm  = np.copy(normalizer[xs:xe,ys:ye])
+        prev_val    = np.copy(new_image[xs:xe,ys:ye])
+        new_val = np.copy(new_upsamp_patches[i,xs-patch_pos[0]:xe-patch_pos[0],ys-patch_pos[1]:ye-patch_pos[1]])
+
+        if xs != 0 and ys != 0 and xe != new_image.shape[0] and ye != new_image.shape[1]:
+            tmp2 = blending_func[xs-patch_pos[0]:xe-patch_pos[0],ys-patch_pos[1]:ye-patch_pos[1]]
+            normalizer[xs:xe,ys:ye] = np.nansum(np.dstack([~np.isnan(new_val)*1*tmp2, prev_norm]),-1)
+            new_image[xs:xe,ys:ye] = np.nansum(np.dstack([new_val*tmp2, prev_val]),-1)
+        elif xs == 0 and ys == 0: # upper left corner                
+            normalizer[xs:xe,ys:ye] = np.nansum(np.dstack([~np.isnan(new_val)*1*corner, prev_norm]),-1)
+            new_image[xs:xe,ys:ye] = np.nansum(np.dstack([new_val*corner, prev_val]),-1)
+        elif xs == 0 and ye == new_image.shape[1]: # upper right corner
+            tmp3 = np.rot90(corner, -1)[xs-patch_pos[0]:xe-patch_pos[0],ys-patch_pos[1]:ye-patch_pos[1]]
+            normalizer[xs:xe,ys:ye] = np.nansum(np.dstack([~np.isnan(new_val)*1*tmp3, prev_norm]),-1)
+            new_image[xs:xe,ys:ye] = np.nansum(np.dstack([new_val*tmp3, prev_val]),-1)
+        elif xe == new_image.shape[0] and ys == 0: # lower left corner                
+            tmp3 = np.rot90(corner, 1)[xs-patch_pos[0]:xe-patch_pos[0],ys-patch_pos[1]:ye-patch_pos[1]]
+            normalizer[xs:xe,ys:ye] = np.nansum(np.dstack([~np.isnan(new_val)*1*tmp3, prev_norm]),-1)
+            new_image[xs:xe,ys:ye] = np.nansum(np.dstack([new_val*tmp3, prev_val]),-1)
+        elif xe == new_image.shape[0] and ye == new_image.shape[1]: # lower right corner
+            tmp3 = np.rot90(corner, 2)[xs-patch_pos[0]:xe-patch_pos[0],ys-patch_pos[1]:ye-patch_pos[1]]               
+            normalizer[xs:xe,ys:ye] = np.nansum(np.dstack([~np.isnan(new_val)*1*tmp3, prev_norm]),-1)
+            new_image[xs:xe,ys:ye] = np.nansum(np.dstack([new_val*tmp3, prev_val]),-1)
+        elif xs == 0: # upper
+            tmp3 = upper_band[xs-patch_pos[0]:xe-patch_pos[0],ys-patch_pos[1]:ye-patch_pos[1]]                
+            normalizer[xs:xe,ys:ye] = np.nansum(np.dstack([~np.isnan(new_val)*1*tmp3, prev_norm]),-1)
+            new_image[xs:xe,ys:ye] = np.nansum(np.dstack([new_val*tmp3, prev_val]),-1)
+        elif xe == new_image.shape[0]: # lower
+            tmp3 = np.flip(upper_band, 0)[xs-patch_pos[0]:xe-patch_pos[0],ys-patch_pos[1]:ye-patch_pos[1]]  
+            normalizer[xs:xe,ys:ye] = np.nansum(np.dstack([~np.isnan(new_val)*1*tmp3, prev_norm]),-1)
+            new_image[xs:xe,ys:ye] = np.nansum(np.dstack([new_val*tmp3, prev_val]),-1)
+        elif ys == 0: # left
+            tmp3 = left_band[xs-patch_pos[0]:xe-patch_pos[0],ys-patch_pos[1]:ye-patch_pos[1]]
+            normalizer[xs:xe,ys:ye] = np.nansum(np.dstack([~np.isnan(new_val)*1*tmp3, prev_norm]),-1)
+            new_image[xs:xe,ys:ye] = np.nansum(np.dstack([new_val*tmp3, prev_val]),-1)
+        elif ye == new_image.shape[1]: # right
+            tmp3 = np.flip(left_band, 1)[xs-patch_pos[0]:xe-patch_pos[0],ys-patch_pos[1]:ye-patch_pos[1]]
+            normalizer[xs:xe,ys:ye] = np.nansum(np.dstack([~np.isnan(new_val)*1*tmp3, prev_norm]),-1)
+            new_image[xs:xe,ys:ye] = np.nansum(np.dstack([new_val*tmp3, prev_val]),-1)
+
+
+    new_image = new_image/normalizer
+    return new_image
+
+
+if __name__ == '__main__':
+    dims = (int(sys.argv[1]), int(sys.argv[2])) if len(sys.argv) > 2 else (480, 752)
+    T = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+    parameters = yaml.load(open(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'example_movies', 'parameters.yaml')), Loader = yaml.Loader)['motion_correction']
+
+    start = time()
+    geometry = PatchGeometry(dims, parameters)
+    geometry_time = time() - start
+    nb_patches = len(geometry.upsamp_patches_index)
+    print("Frames of %ix%i pixels, %i upsampled patches, PatchGeometry built in %.3f s" % (dims[0], dims[1], nb_patches, geometry_time))
+
+    images = np.random.rand(T, dims[0], dims[1]).astype(np.float32)*255
+    patches = np.random.rand(T, nb_patches, geometry.upsamp_wdims[0], geometry.upsamp_wdims[1])*255
+    patches[:,:,:2,:] = np.nan # border of the shifted patches
+
+    start = time()
+    loop = [blend_loop(images[i], patches[i], geometry.upsamp_patches_index, geometry.upsamp_wdims, geometry.new_overlaps) for i in range(T)]
+    loop_time = (time() - start)/T
+    start = time()
+    vectorized = [geometry.blend(images[i], patches[i]) for i in range(T)]
+    vectorized_time = (time() - start)/T
+
+    print("%-12s %12s" % ('', 'ms / frame'))
+    print("%-12s %12.2f" % ('loop', loop_time*1000))
+    print("%-12s %12.2f" % ('bincount', vectorized_time*1000))
+    print("speed up : %.1f, max difference : %g" % (loop_time/vectorized_time, np.max(np.abs(np.array(loop) - np.array(vectorized)))))
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+'''
+    Benchmark of the compression filters of the hdf5 file (see miniscopy.base.utilities.get_storage_options).
+    Write and read throughput and file size are reported for each filter on a synthetic movie
+    generated with miniscopy.generate_data.
+
+    python testbench/benchmark_storage.py [duration] [height] [width]
+'''
+import sys, os, tempfile
+from time import time
+import numpy as np
+import h5py as hd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from miniscopy import generate_data
+from miniscopy.base.utilities import create_dataset, set_storage_options, hdf5plugin
+
+
+def benchmark_filter(movie, storage, dtype, chunk_size = 32):
+    path = tempfile.mkdtemp()
+    filename = os.path.join(path, 'benchmark.hdf5')
+    file = hd.File(filename, 'w')
+    set_storage_options(file, **storage)
+    start = time()
+    dset = create_dataset(file, 'movie', shape = movie.shape, dtype = dtype, chunks = True)
+    for i in range(0, len(movie), chunk_size):
+        dset[i:i+chunk_size] = movie[i:i+chunk_size]
+    file.close()
+    write_time = time() - start
+    file = hd.File(filename, 'r')
+    start = time()
+    for i in range(0, len(movie), chunk_size):
+        data = file['movie'][i:i+chunk_size]
+    read_time = time() - start
+    file.close()
+    size = os.path.getsize(filename)
+    os.remove(filename)
+    os.rmdir(path)
+    return write_time, read_time, size
+
+
+if __name__ == '__main__':
+    T = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    dims = (int(sys.argv[2]), int(sys.argv[3])) if len(sys.argv) > 3 else (240, 376)
+    N = 20
+    frate = np.random.poisson(0.05, (T, N)).astype(np.float32)
+    movie, true_data = generate_data(frate, N, T, dims)
+    movie = movie - movie.min()
+    movie = (movie * 255. / movie.max()).astype(np.float32)
+
+    filters = [{'filter':None}, {'filter':'lzf'}, {'filter':'lzf', 'shuffle':True}, {'filter':'gzip', 'level':1}, {'filter':'gzip', 'level':4, 'shuffle':True}]
+    if hdf5plugin is not None:
+        filters += [{'filter':'blosc', 'level':5, 'shuffle':True}, {'filter':'lz4', 'shuffle':True}]
+    else:
+        print("hdf5plugin is not installed, blosc and lz4 are not tested")
+
+    print("Movie of %i frames of %ix%i pixels" % (T, dims[0], dims[1]))
+    print("%-50s %-8s %12s %12s %10s" % ('filter', 'dtype', 'write MB/s', 'read MB/s', 'size MB'))
+    for dtype in ['float32', 'uint8']:
+        data = np.round(movie).astype(dtype)
+        for storage in filters:
+            write_time, read_time, size = benchmark_filter(data, storage, dtype)
+            print("%-50s %-8s %12.1f %12.1f %10.1f" % (str(storage), dtype, data.nbytes/write_time/1e6, data.nbytes/read_time/1e6, size/1e6))
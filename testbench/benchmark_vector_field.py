@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+'''
+    Benchmark of the vector field of the shifts of the patches.
+    tile_and_correct used to build the grid of the patches and the U, V fields of every frame with python loops
+    although they were not used. The loops are copied below as a reference and compared with vector_field,
+    which is now only called for the figures (get_vector_field_image), for the time per frame and the difference of the fields.
+
+    python testbench/benchmark_vector_field.py [height] [width] [nb_frames]
+'''
+import sys, os
+from time import time
+import numpy as np
+import cv2
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from miniscopy.base.motion_correction import PatchGeometry, vector_field, tile_and_correct
+
+
+def vector_field_loop(matrix_X, matrix_Y, strides, wdims, pdims, dims):
+    """ vector_field with the loops over the patches """
+    x= np.zeros(pdims[1])
+    y= np.zeros(pdims[0])
+    for i in range(0,pdims[1]):
+        x[i]= np.minimum(strides[1]*i + wdims[1]/2, dims[1])
+    for j in range(0,pdims[0]):
+        y[j]= np.minimum(strides[0]*j + wdims[0]/2, dims[0])
+    X,Y = np.meshgrid(x,y)
+
+    X_flat = np.ravel(X.copy())
+    Y_flat = np.ravel(Y.copy())
+    U_flat= np.ravel(matrix_Y.copy())
+    V_flat = np.ravel(matrix_X.copy())
+    xp = np.zeros(U_flat.shape)
+    yp = np.zeros(V_flat.shape)
+    xp.fill(np.nan)
+    yp.fill(np.nan)
+    for i, uf in enumerate(U_flat):
+        if uf == 0 and V_flat[i] == 0 : # if there is no shift
+            U_flat[i] = None
+            V_flat[i] = None
+            xp[i] = X_flat[i]
+            yp[i] = Y_flat[i]
+
+    U = U_flat.reshape(pdims)
+    V = V_flat.reshape(pdims)
+    Xp = xp.reshape(pdims)
+    Yp = yp.reshape(pdims)
+
+    return (X,Y,U,V,Xp,Yp)
+
+
+if __name__ == '__main__':
+    dims = (int(sys.argv[1]), int(sys.argv[2])) if len(sys.argv) > 2 else (480, 752)
+    T = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+    parameters = yaml.load(open(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'example_movies', 'parameters.yaml')), Loader = yaml.Loader)['motion_correction']
+
+    geometry = PatchGeometry(dims, parameters)
+    pdims, upsamp_pdims = geometry.pdims, geometry.upsamp_pdims
+    print("Frames of %ix%i pixels, %ix%i patches upsampled to %ix%i" % (dims[0], dims[1], pdims[0], pdims[1], upsamp_pdims[0], upsamp_pdims[1]))
+
+    shifts = np.round(np.random.randn(T, 2, pdims[0], pdims[1])*2)/2 # some patches are not shifted
+    shift_img = [[cv2.resize(s, (upsamp_pdims[1],upsamp_pdims[0]), interpolation = cv2.INTER_CUBIC) for s in shift] for shift in shifts]
+
+    start = time()
+    loop = [vector_field_loop(s[0], s[1], geometry.new_strides, geometry.upsamp_wdims, upsamp_pdims, dims) for s in shift_img]
+    loop_time = (time() - start)/T
+    start = time()
+    vectorized = [vector_field(s[0], s[1], geometry.new_strides, geometry.upsamp_wdims, upsamp_pdims, dims) for s in shift_img]
+    vectorized_time = (time() - start)/T
+    difference = np.max([np.max(np.abs(np.nan_to_num(a, nan = -1) - np.nan_to_num(b, nan = -1))) for l, v in zip(loop, vectorized) for a, b in zip(l, v)])
+
+    # time of the correction of a frame without the vector field for reference
+    image = np.random.rand(dims[0], dims[1]).astype(np.float32)*255
+    shifts_patch = np.stack([shifts[:,0].reshape(T, -1), shifts[:,1].reshape(T, -1)], -1)
+    nb_frames = min(T, 20)
+    start = time()
+    for i in range(nb_frames):
+        tile_and_correct(image.copy(), None, dims, parameters, shifts_patch[i])
+    correct_time = (time() - start)/nb_frames
+
+    print("%-30s %12s" % ('', 'ms / frame'))
+    print("%-30s %12.3f" % ('vector field with loops', loop_time*1000))
+    print("%-30s %12.3f" % ('vector field vectorized', vectorized_time*1000))
+    print("%-30s %12.3f" % ('tile_and_correct', correct_time*1000))
+    print("saving per frame in tile_and_correct : %.3f ms (%.1f%%), speed up of vector_field : %.1f, max difference : %g" % (loop_time*1000, 100*loop_time/(correct_time+loop_time), loop_time/vectorized_time, difference))
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+
+import unittest
+import sys, os
+import shutil
+import tempfile
+import io
+import contextlib
+import numpy as np
+import cv2
+import av
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import miniscopy.base.motion_correction as mc
+
+def write_videos(folder, nb_files = 3, nb_frames = 50, dims = (120, 160), seed = 0):
+    """ Write avi files of a blurred noise image shifted by a few pixels in each frame. Returns the files and the shift of each frame """
+    rng = np.random.RandomState(seed)
+    base = cv2.GaussianBlur((rng.rand(*dims)*100).astype(np.float32), (0, 0), 3)*3
+    files, shifts = [], []
+    for f in range(nb_files):
+        files.append(os.path.join(folder, 'msCam%i.avi' % (f+1)))
+        container = av.open(files[-1], 'w')
+        stream = container.add_stream('ffv1', rate = 30)
+        stream.width, stream.height = dims[1], dims[0]
+        stream.pix_fmt = 'bgr0'
+        for i in range(nb_frames):
+            shifts.append(rng.randint(-2, 3, 2))
+            image = np.roll(base, tuple(shifts[-1]), (0, 1)) + rng.rand(*dims)*5
+            frame = av.VideoFrame.from_ndarray(np.dstack([np.clip(image, 0, 255).astype(np.uint8)]*3), format = 'bgr24')
+            for packet in stream.encode(frame):
+                container.mux(packet)
+        for packet in stream.encode():
+            container.mux(packet)
+        container.close()
+    return files, np.array(shifts)
+
+def get_parameters(**kwargs):
+    parameters = yaml.load(open(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'example_movies', 'parameters.yaml')), Loader = yaml.Loader)['motion_correction']
+    parameters.update(save_original = True, cache = False, chunk_frames = 10, chunk_size = 10, block_size = 30)
+    parameters.update(kwargs)
+    return parameters
+
+def run(files, parameters):
+    hdf_mov, video_info = mc.normcorre(files, None, parameters)
+    movie = hdf_mov['movie'][:]
+    motion = {k:hdf_mov['motion'][k][:] for k in hdf_mov['motion'].keys()} if 'motion' in hdf_mov.keys() else {}
+    hdf_mov.close()
+    return movie, motion
+
+class CTestMotionCorrection(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.folder = tempfile.mkdtemp()
+        cls.files, cls.shifts = write_videos(cls.folder)
+    #
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.folder)
+    #
+    def interrupt(self, parameters, nb_round, frame, stage = 'read'):
+        """ Run the motion correction and make the read or the write of the chunk that starts at frame fail in the round nb_round.
+        The chunks corrected before it are written """
+        function = 'read_frames' if stage == 'read' else 'cast_frames'
+        original = getattr(mc, function)
+        calls = []
+        def failing(*args):
+            calls.append(args)
+            # read_frames(dataset, start, end, out) or cast_frames(frames, dtype) of each chunk of 10 frames of the 150 frames of a round
+            if (stage == 'read' and [c[1] for c in calls].count(frame) == nb_round+1) or (stage == 'write' and len(calls) == 15*nb_round + frame//10 + 1):
+                raise RuntimeError("interrupted")
+            return original(*args)
+        setattr(mc, function, failing)
+        try:
+            with self.assertRaises(RuntimeError):
+                mc.normcorre(self.files, None, parameters)
+        finally:
+            setattr(mc, function, original)
+    #
+    def test_resume(self):
+        for pipeline in [True, False]:
+            parameters = get_parameters(pipeline = pipeline)
+            movie, motion = run(self.files, parameters)
+            # stopped in the middle of the second block of the first or of the second round, the frames 30 to 49 are written
+            for nb_round, stage in [(0, 'read'), (1, 'read'), (1, 'write')]:
+                self.interrupt(parameters, nb_round, 50, stage)
+                resumed, motion_resumed = run(self.files, dict(parameters, resume = True))
+                np.testing.assert_allclose(resumed, movie, atol = 1e-3)
+                for name in ['shifts_rigid', 'shifts_patch', 'corr', 'shear']:
+                    np.testing.assert_allclose(motion_resumed[name], motion[name], atol = 1e-6, err_msg = name)
+    #
+    def test_resume_mode(self):
+        # the mode chosen before the interruption is kept even if the sample of frames would give another one
+        parameters = get_parameters(mode = 'auto', nb_round = 1)
+        get_correction_mode = mc.get_correction_mode
+        try:
+            mc.get_correction_mode = lambda *args: 'rigid'
+            self.interrupt(parameters, 0, 50)
+            mc.get_correction_mode = lambda *args: 'piecewise'
+            hdf_mov, video_info = mc.normcorre(self.files, None, dict(parameters, resume = True))
+            self.assertEqual(hdf_mov['movie'].attrs['mc_mode'], 'rigid')
+            np.testing.assert_array_equal(hdf_mov['motion/shifts_patch'][:], 0)
+            hdf_mov.close()
+        finally:
+            mc.get_correction_mode = get_correction_mode
+    #
+    def test_cache(self):
+        folder = tempfile.mkdtemp()
+        get_hdf_file = mc.get_hdf_file
+        decoded = []
+        def counting(*args, **kwargs):
+            decoded.append(args)
+            return get_hdf_file(*args, **kwargs)
+        def correct(**kwargs):
+            # returns the attributes of the movie and if the videos were decoded, the movie is marked to know if it is written again
+            del decoded[:]
+            hdf_mov, video_info = mc.normcorre(files, None, get_parameters(cache = True, nb_round = 1, **kwargs))
+            attrs = dict(hdf_mov['movie'].attrs)
+            tiled = hdf_mov['movie_tiled'].chunks if 'movie_tiled' in hdf_mov.keys() else None
+            if tiled is not None:
+                np.testing.assert_array_equal(hdf_mov['movie_tiled'][:], hdf_mov['movie'][:])
+            hdf_mov['movie'].attrs['marker'] = True
+            hdf_mov.close()
+            return attrs, len(decoded) > 0, tiled
+        mc.get_hdf_file = counting
+        try:
+            files, shifts = write_videos(folder, nb_files = 2, nb_frames = 20)
+            attrs, decode, tiled = correct()
+            self.assertTrue(decode)
+            # same parameters, or only a parameter of the run : the corrected movie is returned as it is
+            for kwargs in [{}, {'frames_per_task': 3}]:
+                attrs_cached, decode, tiled = correct(**kwargs)
+                self.assertFalse(decode)
+                self.assertTrue(attrs_cached.get('marker', False))
+                self.assertEqual(attrs_cached['mc_key'], attrs['mc_key'])
+            # the tiled copy is written on a cache hit
+            attrs_cached, decode, tiled = correct(tiled_copy = True, tile_frames = 16)
+            self.assertTrue(attrs_cached.get('marker', False))
+            self.assertEqual(tiled[0], 16)
+            # another parameter of the correction : corrected again from the dataset original
+            attrs_changed, decode, tiled = correct(max_shifts = [4, 4])
+            self.assertFalse(decode)
+            self.assertFalse(attrs_changed.get('marker', False))
+            self.assertNotEqual(attrs_changed['mc_key'], attrs['mc_key'])
+            self.assertIsNone(tiled)
+            # a video modified since : decoded again
+            os.utime(files[1], ns = (os.stat(files[1]).st_atime_ns, os.stat(files[1]).st_mtime_ns + 10**9))
+            attrs_changed, decode, tiled = correct(max_shifts = [4, 4])
+            self.assertTrue(decode)
+            self.assertFalse(attrs_changed.get('marker', False))
+        finally:
+            mc.get_hdf_file = get_hdf_file
+            shutil.rmtree(folder)
+    #
+    def test_running_template(self):
+        # the shifts recovered with the template updated after each chunk, up to the offset of the first template
+        movie, motion = run(self.files, get_parameters(template_update = 'running'))
+        errors = motion['shifts_rigid'] + self.shifts
+        np.testing.assert_allclose(errors, np.median(errors, 0) + np.zeros_like(errors), atol = 0.3)
+        movie_block, motion_block = run(self.files, get_parameters())
+        self.assertLess(np.mean(np.abs(movie - movie_block)), 0.2)
+    #
+    def test_adaptive(self):
+        # the frames whose shifts are below recorrect_shift in a round are not corrected in the next ones
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            movie, motion = run(self.files, get_parameters(adaptive = True, nb_round = 3))
+        nb_corrected = [int(line.split()[-3]) for line in output.getvalue().splitlines() if line.startswith('Round')]
+        self.assertEqual(nb_corrected[0], 150)
+        self.assertLess(nb_corrected[1], nb_corrected[0])
+        self.assertLess(nb_corrected[2], nb_corrected[1]/2)
+        self.assertLessEqual(motion['active'].sum(), nb_corrected[2])
+    #
+    def test_deferred(self):
+        parameters = get_parameters(deferred = True)
+        hdf_mov, video_info = mc.normcorre(self.files, None, parameters)
+        original, movie = hdf_mov['original'][:], hdf_mov['movie'][:]
+        shifts = (hdf_mov['motion/shifts_rigid'][:], hdf_mov['motion/shifts_patch'][:])
+        hdf_mov.close()
+        # the movie is the original corrected once with the shifts of the last round
+        np.testing.assert_allclose(movie, mc.apply_shifts(original.copy(), shifts, (120, 160), parameters), atol = 1e-3)
+        errors = shifts[0] + self.shifts
+        np.testing.assert_allclose(errors, np.median(errors, 0) + np.zeros_like(errors), atol = 0.3)
+        movie_rounds, motion_rounds = run(self.files, get_parameters())
+        self.assertLess(np.mean(np.abs(movie - movie_rounds)), 0.25*np.mean(np.abs(original - movie_rounds)))
+    #
+    def test_memmap(self):
+        movie, motion = run(self.files, get_parameters())
+        movie_memmap, motion_memmap = run(self.files, get_parameters(backend = 'memmap'))
+        np.testing.assert_array_equal(movie_memmap, movie)
+        for name in motion.keys():
+            np.testing.assert_array_equal(motion_memmap[name], motion[name], err_msg = name)
+    #
+    def test_video_store(self):
+        hdf_mov, video_info = mc.normcorre(self.files, None, get_parameters(nb_round = 1))
+        original = hdf_mov['original'][:]
+        hdf_mov.close()
+        # blocks smaller than the videos and a cache smaller than the frames read : the blocks are decoded again after a seek
+        store = mc.VideoStore(self.files, block_size = 16, cache_size = 2)
+        try:
+            self.assertEqual(store.shape, original.shape)
+            np.testing.assert_array_equal(store[:], original)
+            for rows in [slice(45, 55), slice(140, 20, -7), [70, 3, 149, 48, 49, 50], 99, -1]:
+                np.testing.assert_array_equal(store[rows], original[rows])
+            np.testing.assert_array_equal(store[60:70, 100:200], original[60:70, 100:200])
+        finally:
+            store.close()
+    #
+    def test_remap_field(self):
+        rng = np.random.RandomState(0)
+        dims = (120, 160)
+        parameters = {'strides': (30, 30), 'overlaps': (6, 6), 'upsample_factor_grid': 1, 'max_shifts': [3, 3], 'filter_size_patch': 5, 'upsample_factor': 2}
+        template = cv2.GaussianBlur(rng.rand(*dims).astype(np.float32), (0, 0), 2)*255
+        # smooth field of shifts, below the shear of 0.5 pixel between patches for which the patches are blended
+        grid_x, grid_y = np.meshgrid(np.arange(dims[1], dtype = np.float32), np.arange(dims[0], dtype = np.float32))
+        shift_rows, shift_columns = np.sin(grid_x/dims[1]*np.pi).astype(np.float32), (0.8*grid_y/dims[0]).astype(np.float32)
+        image = cv2.remap(template, grid_x + shift_columns, grid_y + shift_rows, cv2.INTER_CUBIC, borderMode = cv2.BORDER_REFLECT)
+        geometry = mc.get_patch_geometry(dims, parameters)
+        centers = [np.minimum(geometry.patches_index[:, a] + geometry.wdims[a], dims[a]) / 2. + geometry.patches_index[:, a] / 2. - 0.5 for a in range(2)]
+        shifts_patch = np.array([[shift_rows[int(r), int(c)], shift_columns[int(r), int(c)]] for r, c in zip(*centers)])
+        # the interpolated field is the shift of each patch at its center
+        field = cv2.remap(np.float32(shifts_patch[:, 0].reshape(geometry.pdims)), geometry.field_x, geometry.field_y, cv2.INTER_LINEAR)
+        np.testing.assert_allclose(field[centers[0].astype(int), centers[1].astype(int)], shifts_patch[:, 0], atol = 0.02)
+        errors = {}
+        for apply_mode in ['patches', 'remap']:
+            corrected = mc.tile_and_correct(image.copy(), None, dims, dict(parameters, apply_mode = apply_mode), shifts_patch).reshape(dims)
+            errors[apply_mode] = np.mean(np.abs(corrected - template)[5:-5, 5:-5])
+        self.assertLess(errors['remap'], errors['patches'])
+        self.assertLess(errors['remap'], 0.15*np.mean(np.abs(image - template)[5:-5, 5:-5]))
+    #
+#
+
+if __name__ == '__main__':
+    unittest.main()
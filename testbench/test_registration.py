@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+import unittest
+import sys, os
+import numpy as np
+import cv2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from miniscopy.base.sima_functions import register_translation, register_translation_batch
+from miniscopy.base.motion_correction import PreparedTemplate, estimate_shifts, update_template, get_global_shift
+
+class CTestRegistration(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.images = []
+        for shape in [(36, 36), (35, 36), (24, 17)]:
+            base = cv2.GaussianBlur(rng.rand(shape[0]+10, shape[1]+10).astype(np.float32), (7, 7), 2)
+            src = np.array([base[5:5+shape[0], 5:5+shape[1]]] * 10)
+            tgt = np.array([np.roll(base, tuple(rng.randint(-3, 4, 2)), (0, 1))[5:5+shape[0], 5:5+shape[1]] for i in range(10)])
+            self.images.append((src, tgt + 0.01*rng.rand(*tgt.shape).astype(np.float32)))
+    #
+    def test_batch_same_as_loop(self):
+        for src, tgt in self.images:
+            for upsample_factor in [1, 2, 4]:
+                shifts = np.array([register_translation(s, t, upsample_factor, "real", None, None, [3, 3])[0] for s, t in zip(src, tgt)])
+                shifts_batch, phasediff = register_translation_batch(src, tgt, upsample_factor, [3, 3])
+                np.testing.assert_allclose(shifts_batch, shifts)
+                # one template broadcast against every image
+                shifts_batch, phasediff = register_translation_batch(src[0], tgt, upsample_factor, [3, 3])
+                np.testing.assert_allclose(shifts_batch, shifts)
+    #
+    def test_single_precision(self):
+        for src, tgt in self.images:
+            for upsample_factor in [1, 2, 4, 10]:
+                shifts, phasediff = register_translation_batch(src, tgt, upsample_factor, [3, 3])
+                shifts_single, phasediff = register_translation_batch(src, tgt, upsample_factor, [3, 3], dtype = np.float32)
+                # the peak can move by one step of the upsampled grid when two values are almost equal
+                np.testing.assert_allclose(shifts_single, shifts, atol = 1.0/upsample_factor + 1e-9)
+                self.assertGreaterEqual(np.mean(np.all(shifts_single == shifts, -1)), 0.9)
+                shifts = np.array([register_translation(s, t, upsample_factor, "real", None, None, [3, 3])[0] for s, t in zip(src, tgt)])
+                shifts_single = np.array([register_translation(s, t, upsample_factor, "real", None, None, [3, 3], dtype = np.float32)[0] for s, t in zip(src, tgt)])
+                np.testing.assert_allclose(shifts_single, shifts, atol = 1.0/upsample_factor + 1e-9)
+    #
+    def test_rigid_mode(self):
+        rng = np.random.RandomState(1)
+        dims = (60, 80)
+        parameters = {'max_deviation_rigid': 5, 'filter_size': 5, 'filter_size_patch': 5, 'strides': (30, 30), 'overlaps': (6, 6), 'upsample_factor_grid': 1, 'max_shifts': [3, 3], 'upsample_factor': 2}
+        base = cv2.GaussianBlur(rng.rand(dims[0]+20, dims[1]+20).astype(np.float32), (9, 9), 3)*255
+        shifts = np.array([[1, 0], [-1, 0], [0, 1], [0, -1], [2, -1], [-3, 2]])
+        images = np.array([np.roll(base, tuple(s), (0, 1))[10:10+dims[0], 10:10+dims[1]].ravel() for s in shifts])
+        template = PreparedTemplate(base[10:10+dims[0], 10:10+dims[1]], dims, parameters)
+        corrected, rigid, patch = estimate_shifts(images.copy(), template, dims, dict(parameters, mode = 'rigid'))
+        # the shift that corrects each image, the same as in the piecewise mode, and no shift of the patches
+        np.testing.assert_allclose(rigid, -shifts, atol = 0.1)
+        np.testing.assert_allclose(rigid, estimate_shifts(images.copy(), template, dims, parameters)[1])
+        np.testing.assert_array_equal(patch, 0)
+    #
+    def test_pyramid_search(self):
+        # shifts larger than max_deviation_rigid / 2**pyramid_levels, found at the coarse scale
+        rng = np.random.RandomState(3)
+        dims = (100, 120)
+        parameters = {'max_deviation_rigid': 12, 'filter_size': 5, 'filter_size_patch': 5, 'strides': (50, 60), 'overlaps': (6, 6), 'upsample_factor_grid': 1, 'max_shifts': [3, 3], 'upsample_factor': 2}
+        base = cv2.GaussianBlur(rng.rand(dims[0]+40, dims[1]+40).astype(np.float32), (0, 0), 3)*255
+        template = base[20:20+dims[0], 20:20+dims[1]]
+        for shift in [(9, -7), (-9, 11), (4, 9), (-11, -10)]:
+            image = np.roll(base, shift, (0, 1))[20:20+dims[0], 20:20+dims[1]] + rng.rand(*dims).astype(np.float32)
+            pyramid = get_global_shift(image, PreparedTemplate(template, dims, dict(parameters, pyramid_levels = 2)), dims, dict(parameters, pyramid_levels = 2))
+            np.testing.assert_allclose(pyramid, -np.array(shift), atol = 0.1)
+            np.testing.assert_allclose(pyramid, get_global_shift(image, PreparedTemplate(template, dims, parameters), dims, parameters), atol = 1e-6)
+    #
+    def test_update_template(self):
+        rng = np.random.RandomState(2)
+        dims = (30, 40)
+        median = cv2.GaussianBlur(rng.rand(*dims).astype(np.float32), (0, 0), 2)*255
+        # frames on both sides of the template by the same amount : it does not move
+        frames = np.array([median - 3, median + 3, median - 1, median + 1]).reshape(4, -1)
+        np.testing.assert_allclose(update_template(median, frames, dims), median, atol = 1e-4)
+        # from a template too bright by 10, it gets close to the median of noisy frames in a few chunks
+        template = median + 10
+        for i in range(8):
+            template = update_template(template, (median + rng.laplace(0, 5, (10,)+dims)).reshape(10, -1), dims, 0.5)
+        self.assertLess(np.mean(np.abs(template - median)), 1)
+    #
+#
+
+if __name__ == '__main__':
+    unittest.main()